@@ -3,12 +3,10 @@ import cv2
 import numpy as np
 import torch
 from util import car_center
+from camera_model import DEFAULT_RESOLUTION
 
-IMG_WIDTH = 1024
-IMG_HEIGHT = IMG_WIDTH // 16 * 5
 
-
-def preprocess(img):
+def preprocess(img, res=DEFAULT_RESOLUTION):
     # cut sky (top half of image)
     img = img[img.shape[0] // 2:]
     # extend left and right
@@ -16,16 +14,17 @@ def preprocess(img):
     pad = np.ones_like(img) * img.mean(1, keepdims=True).astype(img.dtype)
     pad = pad[:, :img.shape[1] // 6]
     img = np.concatenate([pad, img, pad], 1)
-    img = cv2.resize(img, (IMG_WIDTH, IMG_HEIGHT))
+    img = cv2.resize(img, (res.img_width, res.img_height))
     img = (img / 255).astype('float32')
     return img
 
 
 class ImageDataset(Dataset):
-    def __init__(self, data, root, camera):
+    def __init__(self, data, root, camera, res=DEFAULT_RESOLUTION):
         self.data = data
         self.root = root
         self.camera = camera
+        self.res = res
 
     def __len__(self):
         return len(self.data)
@@ -38,8 +37,9 @@ class ImageDataset(Dataset):
         img_id, labels = self.data.to_numpy()[idx]
         img_name = self.root + img_id + '.jpg'
         img = cv2.imread(img_name)
-        img = preprocess(img)
+        # the grid coordinates come from the raw image shape, not the preprocessed one
+        center, center_far = car_center(img.shape, labels, self.camera, self.res)
+        img = preprocess(img, self.res)
         img = np.rollaxis(img, 2, 0)
-        center, center_far = car_center(img, labels, self.camera)
         center_far = np.rollaxis(center_far, 2, 0)
         return [img, center, center_far]
@@ -0,0 +1,108 @@
+##########################################################################
+# Encoder backbones for MyUNet / ConvMultiRes
+#
+# Every backbone exposes extract_features(x) (stride 32 feature map) like
+# EfficientNet does. Weights come from BACKBONE_CACHE ('<name>*.pth'); when
+# they are missing they are downloaded once into the cache, and offline the
+# encoder starts from random weights with a warning.
+##########################################################################
+import glob
+import os
+import warnings
+import torch
+import torch.nn as nn
+
+BACKBONE_CACHE = './pretrained/'
+BACKBONES = {}
+
+
+def register_backbone(*names):
+    def wrap(builder):
+        for name in names:
+            BACKBONES[name] = builder
+        return builder
+    return wrap
+
+
+def _cached_weights(name, cache_dir):
+    files = sorted(glob.glob(os.path.join(cache_dir, name + '*.pth')))
+    return files[0] if files else None
+
+
+@register_backbone(*['efficientnet-b{}'.format(i) for i in range(8)])
+def _efficientnet(name, pretrained, cache_dir):
+    from efficientnet_pytorch import EfficientNet
+    model = EfficientNet.from_name(name)
+    if not pretrained:
+        return model
+    path = _cached_weights(name, cache_dir)
+    if path is not None:
+        state = torch.load(path, map_location='cpu')
+        # the classifier head is never used and may come from a different number of classes
+        state = {k: v for k, v in state.items() if not k.startswith('_fc.')}
+        result = model.load_state_dict(state, strict=False)
+        wrong = [k for k in result.missing_keys + result.unexpected_keys if not k.startswith('_fc.')]
+        if wrong:
+            raise RuntimeError('{} does not match {}: {} missing / unexpected keys, e.g. {}'.format(
+                path, name, len(wrong), wrong[:5]))
+        return model
+    try:
+        model = EfficientNet.from_pretrained(name)
+    except Exception as e:
+        warnings.warn('No weights for {} in {} and download failed ({}), using random init'.format(
+            name, cache_dir, e))
+        return model
+    os.makedirs(cache_dir, exist_ok=True)
+    torch.save(model.state_dict(), os.path.join(cache_dir, name + '.pth'))
+    return model
+
+
+class TorchvisionEncoder(nn.Module):
+    '''features part of a torchvision classifier with the EfficientNet interface'''
+
+    def __init__(self, features):
+        super(TorchvisionEncoder, self).__init__()
+        self.features = features
+
+    def extract_features(self, x):
+        return self.features(x)
+
+    def forward(self, x):
+        return self.features(x)
+
+
+@register_backbone('mobilenet_v2', 'mobilenet_v3_small', 'mobilenet_v3_large')
+def _mobilenet(name, pretrained, cache_dir):
+    # optional dependency, only needed for these encoders
+    import torchvision
+    model = getattr(torchvision.models, name)(weights=None)
+    if pretrained:
+        path = _cached_weights(name, cache_dir)
+        if path is not None:
+            model.load_state_dict(torch.load(path, map_location='cpu'))
+        else:
+            try:
+                weights = torchvision.models.get_model_weights(name).DEFAULT
+                model.load_state_dict(weights.get_state_dict(progress=False))
+                os.makedirs(cache_dir, exist_ok=True)
+                torch.save(model.state_dict(), os.path.join(cache_dir, name + '.pth'))
+            except Exception as e:
+                warnings.warn('No weights for {} in {} and download failed ({}), using random init'.format(
+                    name, cache_dir, e))
+    return TorchvisionEncoder(model.features)
+
+
+def build_backbone(name, pretrained=True, cache_dir=BACKBONE_CACHE):
+    if name not in BACKBONES:
+        raise ValueError('Unknown backbone {}, choose from {}'.format(name, sorted(BACKBONES)))
+    return BACKBONES[name](name, pretrained, cache_dir)
+
+
+def feature_channels(backbone):
+    # number of channels of extract_features, found with a small dummy forward
+    training = backbone.training
+    backbone.eval()
+    with torch.no_grad():
+        channels = backbone.extract_features(torch.zeros(1, 3, 64, 64)).shape[1]
+    backbone.train(training)
+    return channels
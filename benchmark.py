@@ -0,0 +1,171 @@
+##########################################################################
+# Latency / FLOPs measurements
+##########################################################################
+import time
+import numpy as np
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+
+def count_flops(fn, *args):
+    # FLOPs of one call of fn(*args), counted on the aten ops (functional convs included)
+    counter = FlopCounterMode(display=False)
+    with torch.no_grad(), counter:
+        fn(*args)
+    return counter.get_total_flops()
+
+
+def measure_latency(fn, *args, repeats=10, warmup=2):
+    # median and p90 wall time of fn(*args) in ms
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            start = time.perf_counter()
+            fn(*args)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            if i >= warmup:
+                times.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': float(np.median(times)), 'p90_ms': float(np.percentile(times, 90))}
+
+
+def sparse_pose_report(model, img_batch, threshold=0, top_k=100, repeats=5):
+    # dense forward vs ConvMultiRes.forward_sparse on the same batch:
+    # FLOPs and latency per image, and the largest difference at the selected cells
+    model.eval()
+    n = img_batch.shape[0]
+    with torch.no_grad():
+        dense = model(img_batch)
+        sparse, points = model.forward_sparse(img_batch, threshold, top_k)
+    diff = 0.0
+    for i, p in enumerate(points):
+        if len(p):
+            diff = max(diff, float((dense[i, :, p[:, 0], p[:, 1]] - sparse[i, :, p[:, 0], p[:, 1]]).abs().max()))
+    report = {'peaks_per_image': sum(len(p) for p in points) / n, 'max_abs_diff': diff}
+    for name, fn in [('dense', model), ('sparse', lambda x: model.forward_sparse(x, threshold, top_k))]:
+        report[name + '_gflops_per_image'] = count_flops(fn, img_batch) / n / 1e9
+        report[name + '_ms_per_image'] = measure_latency(fn, img_batch, repeats=repeats)['median_ms'] / n
+    return report
+
+
+def backbone_table(names, dev_loader, train_loader=None, epochs=0, device='cpu', out=None):
+    # latency / FLOPs / size vs dev loss of ConvMultiRes for each backbone,
+    # optionally after a short training run on train_loader
+    import pandas as pd
+    from model import ConvMultiRes
+    from backbones import feature_channels
+    from engine import train_epoch, evaluate
+    img = next(iter(dev_loader))[0][:1].to(device)
+    rows = []
+    for name in names:
+        model = ConvMultiRes(8, backbone=name)
+        # probed on CPU before the model moves to device
+        channels = feature_channels(model.base_model)
+        model = model.to(device)
+        if train_loader is not None and epochs:
+            optimizer = torch.optim.Adam(model.parameters(), lr=0.001, weight_decay=0.01)
+            for epoch in range(epochs):
+                train_epoch(model, train_loader, optimizer, device=device, epoch=epoch, verbose=False)
+        model.eval()
+        rows.append({'backbone': name,
+                     'feature_channels': channels,
+                     'backbone_params_M': sum(p.numel() for p in model.base_model.parameters()) / 1e6,
+                     'params_M': sum(p.numel() for p in model.parameters()) / 1e6,
+                     'gflops_per_image': count_flops(model.to(device), img) / 1e9,
+                     'ms_per_image': measure_latency(model, img, repeats=5)['median_ms'],
+                     'dev_loss': evaluate(model, dev_loader, device, verbose=False)})
+        print(rows[-1])
+    table = pd.DataFrame(rows)
+    if out is not None:
+        table.to_csv(out, index=False)
+    return table
+
+
+def _saved_bytes(fn, *args):
+    # bytes of the tensors autograd keeps for backward during fn(*args), each storage counted once
+    storages = {}
+
+    def pack(t):
+        storage = t.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn(*args)
+    return out, sum(storages.values())
+
+
+def criterion_report(batch_sizes=(4, 8, 16, 32), grid=(40, 128), cars_per_image=10, repeats=10,
+                     device='cpu'):
+    # loss.criterion vs loss.criterion_reference on random batches of the model output size:
+    # forward + backward time, memory saved for backward (and peak memory on cuda), max difference
+    import pandas as pd
+    from loss import criterion, criterion_reference
+    rows = []
+    for batch_size in batch_sizes:
+        torch.manual_seed(0)
+        prediction = torch.randn((batch_size, 8) + grid, device=device)
+        mask = torch.zeros((batch_size,) + grid, device=device)
+        for i in range(batch_size):
+            cells = torch.randperm(grid[0] * grid[1])[:cars_per_image]
+            mask[i].view(-1)[cells] = 1
+        regr = torch.randn((batch_size, 7) + grid, device=device)
+        results = {}
+        for name, fn in [('reference', criterion_reference), ('fused', criterion)]:
+            def step():
+                p = prediction.detach().requires_grad_()
+                loss = fn(p, mask, regr)
+                loss[2].backward()
+                return loss
+            times = []
+            for i in range(repeats + 2):
+                if device != 'cpu':
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_peak_memory_stats()
+                start = time.perf_counter()
+                step()
+                if device != 'cpu':
+                    torch.cuda.synchronize()
+                if i >= 2:
+                    times.append((time.perf_counter() - start) * 1000)
+            p = prediction.detach().requires_grad_()
+            loss, saved = _saved_bytes(fn, p, mask, regr)
+            loss[2].backward()
+            row = {'batch_size': batch_size, 'criterion': name, 'ms': float(np.median(times)),
+                   'saved_for_backward_MB': saved / 2 ** 20}
+            if device != 'cpu':
+                row['peak_MB'] = torch.cuda.max_memory_allocated() / 2 ** 20
+            results[name] = (torch.stack([l.detach() for l in loss]), p.grad)
+            rows.append(row)
+        (ref, ref_grad), (fused, fused_grad) = results['reference'], results['fused']
+        rows[-1]['max_loss_diff'] = float((ref - fused).abs().max())
+        rows[-1]['max_grad_diff'] = float((ref_grad - fused_grad).abs().max())
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    import argparse
+    from torch.utils.data import DataLoader, Subset
+    from load import load_data
+    parser = argparse.ArgumentParser(description='Latency vs dev loss for each backbone')
+    parser.add_argument('--backbones', nargs='+',
+                        default=['efficientnet-b0', 'mobilenet_v3_large', 'mobilenet_v3_small', 'mobilenet_v2'])
+    parser.add_argument('--epochs', type=int, default=0, help='short training run per backbone')
+    parser.add_argument('--train-images', type=int, default=400)
+    parser.add_argument('--dev-images', type=int, default=40)
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--out', default='backbones.csv')
+    parser.add_argument('--criterion', action='store_true', help='benchmark the loss instead, no data needed')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.criterion:
+        print(criterion_report(device=str(device)).to_string())
+        raise SystemExit
+    train_loader, _, validate_data, _ = load_data(args.batch)
+    train_data = train_loader.dataset
+    train_loader = DataLoader(Subset(train_data, range(min(args.train_images, len(train_data)))),
+                              batch_size=args.batch, shuffle=True, num_workers=2)
+    dev_loader = DataLoader(Subset(validate_data, range(min(args.dev_images, len(validate_data)))),
+                            batch_size=args.batch, shuffle=False, num_workers=0)
+    print(backbone_table(args.backbones, dev_loader, train_loader, args.epochs, device, args.out))
@@ -0,0 +1,189 @@
+##########################################################################
+# Preprocessed image cache, one per network resolution
+#
+#   python cache.py --scales 0.5 0.75 1.0 --workers 4
+#   dev_dataset = materialize(dev_dataset, dev_cache_path(df_dev, res))
+#
+# Decoding a 3384x2710 jpg and resizing it costs far more than a training
+# step at low resolution, so the cropped / padded / resized uint8 images
+# are kept in one .npy memmap per (resolution, image list). The cache is
+# filled lazily by the DataLoader workers (or ahead of time with the CLI)
+# and shared by every worker and every epoch through the page cache.
+# materialize goes one step further for the fixed dev split: images and
+# targets are computed once and evaluation just slices arrays.
+##########################################################################
+import hashlib
+import os
+import cv2
+import numpy as np
+from torch.utils.data import Dataset, DataLoader, Subset
+from helper_functions import crop_and_resize
+from camera_model import DEFAULT_RESOLUTION
+
+CACHE_DIR = 'Dataset/cache/'
+
+
+class ImageCache:
+    '''crop_and_resize output of a fixed list of images at one resolution'''
+    '''uint8 [N, H, W, 3] memmap plus a filled flag per image, safe to share between workers'''
+
+    def __init__(self, cache_dir, image_ids, res=DEFAULT_RESOLUTION):
+        self.image_ids = list(image_ids)
+        self.res = res
+        key = _ids_key(self.image_ids)
+        self.path = os.path.join(cache_dir, 'images_{}_{}.npy'.format(res.name, key))
+        self.flags_path = self.path[:-4] + '_filled.npy'
+        self._index = {img_id: i for i, img_id in enumerate(self.image_ids)}
+        self._images = None
+        self._filled = None
+        if not os.path.exists(self.path):
+            os.makedirs(cache_dir, exist_ok=True)
+            shape = (len(self.image_ids), res.img_height, res.img_width, 3)
+            # created under a temporary name so a reader never sees a partial header
+            np.lib.format.open_memmap(self.path + '.tmp', mode='w+', dtype=np.uint8, shape=shape).flush()
+            np.lib.format.open_memmap(self.flags_path, mode='w+', dtype=np.uint8,
+                                      shape=(len(self.image_ids),)).flush()
+            os.replace(self.path + '.tmp', self.path)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getstate__(self):
+        # the memmaps are opened again in each DataLoader worker
+        state = dict(self.__dict__)
+        state['_images'] = state['_filled'] = None
+        return state
+
+    def _open(self):
+        if self._images is None:
+            self._images = np.load(self.path, mmap_mode='r+')
+            self._filled = np.load(self.flags_path, mmap_mode='r+')
+
+    def get(self, img_id, img_name):
+        # cached image of img_id, read from img_name and stored on the first call
+        self._open()
+        i = self._index[img_id]
+        if not self._filled[i]:
+            self._images[i] = crop_and_resize(cv2.imread(img_name), self.res)
+            # flag after the data, a half written image is just recomputed
+            self._filled[i] = 1
+        return self._images[i]
+
+    def missing(self):
+        self._open()
+        return [self.image_ids[i] for i in np.flatnonzero(self._filled == 0)]
+
+
+def _ids_key(image_ids):
+    return hashlib.md5('\n'.join(image_ids).encode()).hexdigest()[:12]
+
+
+class MaterializedDataset(Dataset):
+    '''(img, mask, pose) items held in arrays, in memory or memmapped'''
+    '''images are kept as uint8 (the preprocessing output / 255 is exact), targets as float32'''
+
+    def __init__(self, images, masks, poses):
+        self.images = images
+        self.masks = masks
+        self.poses = poses
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        img = (np.asarray(self.images[idx]) / 255).astype('float32')
+        return [img, np.array(self.masks[idx]), np.array(self.poses[idx])]
+
+
+def dev_cache_path(df, res=DEFAULT_RESOLUTION, cache_dir=CACHE_DIR):
+    # file prefix of a materialized split, keyed by its images, labels and the resolution
+    rows = df['ImageId'] + ' ' + df['PredictionString'].fillna('')
+    return os.path.join(cache_dir, 'dev_{}_{}'.format(res.name, _ids_key(rows)))
+
+
+def materialize(dataset, path=None, batch_size=8, num_workers=2):
+    # every item of a non-augmenting dataset computed once (multi-worker) into a MaterializedDataset;
+    # in memory without path, else in path_{images,masks,poses}.npy memmaps reused by later runs
+    names = ['images', 'masks', 'poses']
+    files = ['{}_{}.npy'.format(path, name) for name in names] if path else None
+    if files and all(os.path.exists(f) for f in files):
+        arrays = [np.load(f, mmap_mode='r') for f in files]
+        if len(arrays[0]) == len(dataset):
+            return MaterializedDataset(*arrays)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    arrays = None
+    n = 0
+    for img, mask, pose in loader:
+        batch = [np.round(img.numpy() * 255).astype(np.uint8), mask.numpy(), pose.numpy()]
+        if arrays is None:
+            shapes = [(len(dataset),) + b.shape[1:] for b in batch]
+            if files:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                arrays = [np.lib.format.open_memmap(f + '.tmp', mode='w+', dtype=b.dtype, shape=shape)
+                          for f, b, shape in zip(files, batch, shapes)]
+            else:
+                arrays = [np.empty(shape, dtype=b.dtype) for b, shape in zip(batch, shapes)]
+        for array, b in zip(arrays, batch):
+            array[n:n + len(b)] = b
+        n += len(batch[0])
+    if files:
+        for array, f in zip(arrays, files):
+            array.flush()
+            # only complete caches get the real names
+            os.replace(f + '.tmp', f)
+        arrays = [np.load(f, mmap_mode='r') for f in files]
+    return MaterializedDataset(*arrays)
+
+
+def fixed_subsample(dataset, n, seed=0):
+    # the same n random items of dataset on every call, for quick periodic evaluation
+    if n >= len(dataset):
+        return dataset
+    idx = np.sort(np.random.RandomState(seed).choice(len(dataset), n, replace=False))
+    return Subset(dataset, idx.tolist())
+
+
+def _fill(job):
+    cache_dir, image_ids, res, root_dir, chunk = job
+    cache = ImageCache(cache_dir, image_ids, res)
+    for img_id in chunk:
+        cache.get(img_id, root_dir.format(img_id))
+    cache._images.flush()
+    cache._filled.flush()
+    return len(chunk)
+
+
+def build_cache(image_ids, root_dir, res=DEFAULT_RESOLUTION, cache_dir=CACHE_DIR, workers=4):
+    # fill every missing image of the cache with a process pool, returns the cache
+    import multiprocessing
+    cache = ImageCache(cache_dir, image_ids, res)
+    missing = cache.missing()
+    chunks = [missing[i::workers] for i in range(workers) if missing[i::workers]]
+    if chunks:
+        with multiprocessing.Pool(len(chunks)) as pool:
+            pool.map(_fill, [(cache_dir, cache.image_ids, res, root_dir, chunk) for chunk in chunks])
+    return cache
+
+
+if __name__ == "__main__":
+    import argparse
+    from camera_model import Resolution
+    from splits import load_splits
+    parser = argparse.ArgumentParser(description='Prebuild the preprocessed image caches')
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.5, 0.75, 1.0])
+    parser.add_argument('--split', choices=['train', 'dev', 'test'], nargs='+', default=['train', 'dev'])
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    PATH = './Dataset/'
+    df_train, df_dev, df_test = load_splits()
+    splits = {'train': (df_train, PATH + 'train_images/{}.jpg'),
+              'dev': (df_dev, PATH + 'train_images/{}.jpg'),
+              'test': (df_test, PATH + 'test_images/{}.jpg')}
+    for split in args.split:
+        df, root_dir = splits[split]
+        for scale in args.scales:
+            res = Resolution.scaled(scale)
+            cache = build_cache(df['ImageId'], root_dir, res, args.cache_dir, args.workers)
+            print(split, res.name, len(cache), 'images ->', cache.path)
@@ -0,0 +1,105 @@
+##########################################################################
+# Camera model shared by every projection
+##########################################################################
+import collections
+import functools
+import os
+import numpy as np
+
+CAMERA_FILE = 'Dataset/camera/camera_intrinsic.txt'
+# intrinsics of the dataset camera, used when the txt file is not around
+FX, FY, CX, CY = 2304.5479, 2305.8757, 1686.2379, 1354.9849
+# raw image (height, width)
+IMG_SHAPE = (2710, 3384)
+
+IMG_WIDTH = 1024
+IMG_HEIGHT = IMG_WIDTH // 16 * 5
+MODEL_SCALE = 8
+
+
+class Resolution(collections.namedtuple('Resolution', ['img_width', 'img_height', 'model_scale'])):
+    '''Network input size and output stride'''
+    '''unpacks into the img_width, img_height, model_scale arguments of Camera.to_grid / from_grid'''
+    __slots__ = ()
+
+    @classmethod
+    def scaled(cls, scale=1.0, model_scale=MODEL_SCALE):
+        # scale x 1024x320 (the "1.0X HD" of the README), width kept a multiple of 64
+        img_width = int(round(IMG_WIDTH * scale / 64)) * 64
+        return cls(img_width, img_width // 16 * 5, model_scale)
+
+    @classmethod
+    def from_grid(cls, grid_shape, model_scale=MODEL_SCALE):
+        # resolution of a network output of grid_shape (rows, cols)
+        return cls(grid_shape[-1] * model_scale, grid_shape[-2] * model_scale, model_scale)
+
+    @property
+    def grid(self):
+        # (rows, cols) of the model output
+        return self.img_height // self.model_scale, self.img_width // self.model_scale
+
+    @property
+    def name(self):
+        return '{}x{}'.format(self.img_width, self.img_height)
+
+
+DEFAULT_RESOLUTION = Resolution(IMG_WIDTH, IMG_HEIGHT, MODEL_SCALE)
+
+
+class Camera:
+    '''Pinhole camera, all methods work on arrays of any shape (e.g. N cars x M points)'''
+
+    def __init__(self, fx=FX, fy=FY, cx=CX, cy=CY):
+        self.fx, self.fy, self.cx, self.cy = float(fx), float(fy), float(cx), float(cy)
+        self.matrix = np.array([[fx, 0, cx],
+                                [0, fy, cy],
+                                [0, 0, 1]], dtype=np.float32)
+
+    @classmethod
+    def from_matrix(cls, camera_mat):
+        return cls(camera_mat[0, 0], camera_mat[1, 1], camera_mat[0, 2], camera_mat[1, 2])
+
+    def project_xyz(self, x, y, z):
+        # camera coordinates -> pixel coordinates (u, v)
+        return x * self.fx / z + self.cx, y * self.fy / z + self.cy
+
+    def project(self, points):
+        # (..., 3) camera coordinates -> (..., 2) pixel coordinates
+        points = np.asarray(points, dtype='float64')
+        u, v = self.project_xyz(points[..., 0], points[..., 1], points[..., 2])
+        return np.stack([u, v], -1)
+
+    def unproject(self, uv, z):
+        # (..., 2) pixel coordinates and depth -> (..., 3) camera coordinates
+        uv = np.asarray(uv, dtype='float64')
+        z = np.broadcast_to(np.asarray(z, dtype='float64'), uv.shape[:-1])
+        x = (uv[..., 0] - self.cx) * z / self.fx
+        y = (uv[..., 1] - self.cy) * z / self.fy
+        return np.stack([x, y, z], -1)
+
+    def to_grid(self, u, v, img_shape=IMG_SHAPE, img_width=IMG_WIDTH, img_height=IMG_HEIGHT,
+                model_scale=MODEL_SCALE):
+        # pixel (u, v) of the raw image -> (row, col) on the model output grid
+        # preprocessing cuts the top half and pads 1/6 of the width on both sides
+        height, width = img_shape[:2]
+        row = (v - height // 2) * img_height / (height // 2) / model_scale
+        col = (u + width // 6) * img_width / (width * 4 / 3) / model_scale
+        return row, col
+
+    def from_grid(self, row, col, img_shape=IMG_SHAPE, img_width=IMG_WIDTH, img_height=IMG_HEIGHT,
+                  model_scale=MODEL_SCALE):
+        # (row, col) on the model output grid -> pixel (u, v) of the raw image
+        height, width = img_shape[:2]
+        v = row * model_scale * (height // 2) / img_height + height // 2
+        u = col * model_scale * (width * 4 / 3) / img_width - width // 6
+        return u, v
+
+
+@functools.lru_cache(maxsize=None)
+def load_camera(path=CAMERA_FILE):
+    # parse camera_intrinsic.txt once per process ("fx = 2304.5479;" per line)
+    if not os.path.exists(path):
+        return Camera()
+    with open(path) as f:
+        fx, fy, cx, cy = [float(f.readline().split()[2][:-1]) for _ in range(4)]
+    return Camera(fx, fy, cx, cy)
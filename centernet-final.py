@@ -1,451 +1,103 @@
-from loading_functions import *
-from helper_functions import *
-from dataset_class import *
+import gc
+import os
+import pandas as pd
+import torch
+import torch.optim as optim
+from torch.optim import lr_scheduler
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from dataset_class import CarDataset
+from splits import load_splits
+from camera_model import Resolution
+from cache import materialize, dev_cache_path, fixed_subsample
+from distributed import init_distributed, cleanup, get_device, make_loader, wrap_model, \
+    unwrap_model, set_epoch, save_on_main
 
 
 ##########################################################################
 # Setup model
 ##########################################################################
-from efficientnet_pytorch import EfficientNet
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-
-EFFNET_VER = 'b0'
-DROPOUT_RATE = 0.3
-# DROPOUT_RATE = 0.0
-
-
-def set_dropout(model, drop_rate):
-    # source:
-    # https://discuss.pytorch.org/t/how-to-increase-dropout-rate-during-training/58107/4
-    for name, child in model.named_children():
-        if isinstance(child, torch.nn.Dropout):
-            child.p = drop_rate
-            print("name:", name)
-            print("children:\n", child)
-
-
-def effnet_dropout(drop_rate):
-    base_model0 = EfficientNet.from_pretrained(f"efficientnet-{EFFNET_VER}")
-    set_dropout(base_model0, drop_rate)
-    return base_model0
-
-
-class double_conv(nn.Module):
-    '''(conv => BN => ReLU) * 2'''
-    '''in_ch=>out_ch,dim_out==dim_in '''
-
-    def __init__(self, in_ch, out_ch):
-        super(double_conv, self).__init__()
-        self.conv = nn.Sequential(
-            nn.Conv2d(in_ch, out_ch, 3, padding=1),
-            nn.BatchNorm2d(out_ch),
-            nn.ReLU(inplace=True),
-            nn.Conv2d(out_ch, out_ch, 3, padding=1),
-            nn.BatchNorm2d(out_ch),
-            nn.ReLU(inplace=True)
-        )
-
-    def forward(self, x):
-        x = self.conv(x)
-        return x
-
-
-class res_block(nn.Module):
-    '''(conv => ReLU)*3 + 1*1Conv+BN '''
-    '''in_ch=>out_ch,dim_out==dim_in '''
-
-    def __init__(self, in_ch, out_ch):
-        super(res_block, self).__init__()
-        self.conv1 = nn.Sequential(
-            nn.Conv2d(in_ch, out_ch//8, 3, padding=1),
-            nn.BatchNorm2d(out_ch//8),
-            nn.ReLU(inplace=True)
-        )
-        self.conv2 = nn.Sequential(
-            nn.Conv2d(out_ch//8, out_ch//8, 3, padding=1),
-            nn.BatchNorm2d(out_ch//8),
-            nn.ReLU(inplace=True)
-        )
-        self.conv3 = nn.Sequential(
-            nn.Conv2d(out_ch//8, out_ch//4, 3, padding=1),
-            nn.BatchNorm2d(out_ch//4),
-            nn.ReLU(inplace=True)
-        )
-        self.bn = nn.BatchNorm2d(out_ch//2)
-        self.sc = nn.Conv2d(in_ch, out_ch//2, 1)
-        self.addconv = nn.Sequential(
-            nn.ReLU(inplace=True),
-            nn.BatchNorm2d(out_ch)
-        )
-
-    def forward(self, x):
-        x_shortcut = self.sc(x)
-        x_p1 = self.conv1(x)
-        x_p2 = self.conv2(x_p1)
-        x_p3 = self.conv3(x_p2)
-        x_path = torch.cat([x_p1, x_p2, x_p3], dim=1)
-        x_path = self.bn(x_path)
-        x_out = torch.cat([x_shortcut, x_path], dim=1)
-        x_out = self.addconv(x_out)
-        return x_out
-
-
-class respath_block(nn.Module):
-    '''3*3Conv + 1*1Conv '''
-    '''in_ch=>out_ch,dim_out==dim_in '''
-
-    def __init__(self, in_ch, out_ch):
-        super(respath_block, self).__init__()
-        self.conv1 = nn.Sequential(
-            nn.Conv2d(in_ch, out_ch//2, 3, padding=1),
-            nn.BatchNorm2d(out_ch//2),
-            nn.ReLU(inplace=True)
-        )
-        self.conv2 = nn.Sequential(
-            nn.Conv2d(in_ch, out_ch//2, 1),
-            nn.BatchNorm2d(out_ch//2)
-        )
-        self.addconv = nn.Sequential(
-            nn.ReLU(inplace=True),
-            nn.BatchNorm2d(out_ch)
-        )
-
-    def forward(self, x):
-        x_p1 = self.conv1(x)
-        x_p2 = self.conv2(x)
-        x_path = torch.cat([x_p1, x_p2], dim=1)
-        x_out = self.addconv(x_path)
-        return x_out
-
-
-class res_path(nn.Module):
-    '''(respath_block)*4 '''
-    '''in_ch=>out_ch,dim_out==dim_in '''
-
-    def __init__(self, in_ch, out_ch):
-        super(res_path, self).__init__()
-#         self.rp1=res_block(in_ch,out_ch)
-#         self.rp2=res_block(out_ch,out_ch)
-#         self.rp3=res_block(out_ch,out_ch)
-#         self.rp4=res_block(out_ch,out_ch)
-        self.rp1 = respath_block(in_ch, out_ch)
-        self.rp2 = respath_block(out_ch, out_ch)
-        self.rp3 = res_block(out_ch, out_ch)
-        self.rp4 = res_block(out_ch, out_ch)
-
-    def forward(self, x):
-        x = self.rp1(x)
-        x = self.rp2(x)
-        x = self.rp3(x)
-        x = self.rp4(x)
-        return x
-
-
-class up_sampling(nn.Module):
-    '''(Respath+ConvT)=>ResBlock '''
-    '''in_ch1(ConvT),in_ch2(Respath)=>out_ch,dim_out==2*dim_in '''
-
-    def __init__(self, in_ch1, in_ch2, out_ch):
-        super(up_sampling, self).__init__()
-        self.up = nn.ConvTranspose2d(
-            in_ch1, in_ch1, 2, stride=2, padding=1, output_padding=1)
-        self.bn = nn.BatchNorm2d(in_ch1)
-        self.relu = nn.ReLU()
-
-        self.respath = res_path(in_ch2, 2*in_ch2)
-
-        self.conv = double_conv(in_ch1+2*in_ch2, out_ch)
-#         self.conv = res_block(in_ch1+2*in_ch2, out_ch)
-
-    def forward(self, x1, x2=None):
-        x1 = self.up(x1)
-        x1 = self.bn(x1)
-        x1 = self.relu(x1)
-
-        x2 = self.respath(x2)
-
-        diffY = x2.size()[2] - x1.size()[2]
-        diffX = x2.size()[3] - x1.size()[3]
-        x1 = F.pad(x1, (diffX // 2, diffX - diffX//2,
-                        diffY // 2, diffY - diffY//2))
-        if x2 is not None:
-            x = torch.cat([x2, x1], dim=1)
-        else:
-            x = x1
-
-        x = self.conv(x)
-        return x
-
-
-class output_conv(nn.Module):
-    '''(conv => BN => ReLU => 1*1conv) '''
-    '''in_ch=>out_ch,dim_out==dim_in '''
-
-    def __init__(self, in_ch, h_ch, out_ch):
-        super(output_conv, self).__init__()
-        self.conv = nn.Sequential(
-            nn.Conv2d(in_ch, h_ch, 3, padding=1),
-            nn.BatchNorm2d(h_ch),
-            nn.ReLU(inplace=True),
-            nn.Conv2d(h_ch, out_ch, 1)
-        )
-
-    def forward(self, x):
-        x = self.conv(x)
-        return x
-
-
-class ConvMultiRes(nn.Module):
-    '''Mixture of previous classes'''
-
-    def __init__(self, n_classes):
-        super(ConvMultiRes, self).__init__()
-        self.drop_rate = DROPOUT_RATE
-        self.base_model = EfficientNet.from_pretrained(f"efficientnet-{EFFNET_VER}")
-#         self.base_model = effnet_dropout(drop_rate = self.drop_rate)
-        self.conv0 = double_conv(3, 64)
-        self.conv1 = double_conv(64, 128)
-        self.conv2 = double_conv(128, 512)
-        self.conv3 = double_conv(512, 1024)
-#         self.conv0 = res_block(3, 64)
-#         self.conv1 = res_block(64, 128)
-#         self.conv2 = res_block(128, 512)
-#         self.conv3 = res_block(512, 1024)
-        self.mp = nn.MaxPool2d(2)
-
-        if EFFNET_VER == 'b0':
-            self.up1 = up_sampling(1280, 1024, 512)
-        elif EFFNET_VER == 'b1':
-            self.up1 = up_sampling(1280, 1024, 512)
-        elif EFFNET_VER == 'b2':
-            self.up1 = up_sampling(1408, 1024, 512)
-        elif EFFNET_VER == 'b3':
-            self.up1 = up_sampling(1536, 1024, 512)
-        elif EFFNET_VER == 'b4':
-            self.up1 = up_sampling(1792, 1024, 512)
-        elif EFFNET_VER == 'b5':
-            self.up1 = up_sampling(2048, 1024, 512)
-#         self.up1 = up_sampling(1536,1024, 512)
-        self.up2 = up_sampling(512, 512, 256)
-#         self.outc = nn.Conv2d(256, n_classes, 1)
-        self.poseconv = output_conv(256, 1024, 7)
-        self.detectionconv = output_conv(256, 256, 1)
-
-    def forward(self, x):
-        # torch.Size([1, 3, 320, 1024])
-        batch_size = x.shape[0]
-
-        x1 = self.mp(self.conv0(x))
-        # torch.Size([1, 64, 160, 512])
-        x2 = self.mp(self.conv1(x1))
-        # torch.Size([1, 128, 80, 256])
-        x3 = self.mp(self.conv2(x2))
-        # torch.Size([1, 512, 40, 128])
-        x4 = self.mp(self.conv3(x3))
-        # torch.Size([1, 1024, 20, 64])
-
-        feats = self.base_model.extract_features(x)
-
-        x = self.up1(feats, x4)
-# torch.Size([1, 512, 20, 64])
-        x = self.up2(x, x3)
-# torch.Size([1, 256, 40, 128])
-
-        xout_1 = self.detectionconv(x)
-
-        xout_2 = self.poseconv(x)
-
-        xout = torch.cat([xout_1, xout_2], dim=1)
-#         xout=self.outc(x)
-
-# torch.Size([1, 8, 40, 128])
-        return xout
+# the network lives in model.py so the other entry points can import it
+from model import ConvMultiRes, load_model
+from ema import ModelEMA, checkpoint
 
 
 ##########################################################################
 # Loss
 ##########################################################################
-import torch
-from tqdm import tqdm
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-def criterion(prediction, mask, regr, size_average=True):
-    # Binary mask loss
-    pred_mask = torch.sigmoid(prediction[:, 0])
-#     plt.imshow(prediction[0, 0].data.cpu().numpy())
-#     plt.show()
-#     print(prediction.shape)
-#     mask_loss = mask * (1 - pred_mask)**2 * torch.log(pred_mask + 1e-12) + (1 - mask) * pred_mask**2 * torch.log(1 - pred_mask + 1e-12)
-    mask_loss = mask * torch.log(pred_mask + 1e-12) + \
-        (1 - mask) * torch.log(1 - pred_mask + 1e-12)
-    mask_loss = -mask_loss.mean(0).sum()
-
-    # Regression L1 loss
-    pred_regr = prediction[:, 1:]
-    temp = torch.abs(pred_regr - regr)
-#     temp=(pred_regr - regr)**2
-#     temp=torch.sqrt(temp)
-    regr_loss = (temp.sum(1) * mask).sum(1).sum(1) / mask.sum(1).sum(1)
-    regr_loss = regr_loss.mean(0)
-
-    gamma = 5.0
-    # Sum
-    loss = mask_loss + gamma*regr_loss
-    if not size_average:
-        loss *= prediction.shape[0]
-    return mask_loss, regr_loss, loss
-
-
-def train_model(epoch, history=None):
-    model.train()
-
-    for batch_idx, (img_batch, mask_batch, regr_batch) in enumerate(tqdm(train_loader)):
-        img_batch = img_batch.to(device)
-        mask_batch = mask_batch.to(device)
-        regr_batch = regr_batch.to(device)
-
-        optimizer.zero_grad()
-        output = model(img_batch)
-        mask_loss, regr_loss, loss = criterion(output, mask_batch, regr_batch)
-        if history is not None:
-            history.loc[epoch + batch_idx /
-                        len(train_loader), 'train_loss'] = loss.data.cpu().numpy()
-            history.loc[epoch + batch_idx /
-                        len(train_loader), 'train_mask_loss'] = mask_loss.data.cpu().numpy()
-            history.loc[epoch + batch_idx /
-                        len(train_loader), 'train_regr_loss'] = regr_loss.data.cpu().numpy()
-
-        loss.backward()
-
-        optimizer.step()
-        exp_lr_scheduler.step()
-
-    print('Train Epoch: {} \tLR: {:.6f}\tLoss: {:.6f}'.format(
-        epoch,
-        optimizer.state_dict()['param_groups'][0]['lr'],
-        loss.data))
-    print('Train mask loss: {:.4f}'.format(mask_loss))
-    print('Train regr loss: {:.4f}'.format(regr_loss))
-
-
-def evaluate_model(epoch, history=None):
-    model.eval()
-    loss = 0
-    mask_loss = 0
-    regr_loss = 0
-
-    with torch.no_grad():
-        for img_batch, mask_batch, regr_batch in dev_loader:
-            img_batch = img_batch.to(device)
-            mask_batch = mask_batch.to(device)
-            regr_batch = regr_batch.to(device)
-
-            output = model(img_batch)
-
-            mask_loss_t, regr_loss_t, loss_t = criterion(
-                output, mask_batch, regr_batch, size_average=False)
-            mask_loss += mask_loss_t
-            regr_loss += regr_loss_t
-            loss += loss_t
-
-    loss /= len(dev_loader.dataset)
-
-    if history is not None:
-        history.loc[epoch, 'dev_loss'] = loss.cpu().numpy()
-        history.loc[epoch, 'dev_mask_loss'] = mask_loss.cpu().numpy()
-        history.loc[epoch, 'dev_regr_loss'] = regr_loss.cpu().numpy()
-
-    print('Dev loss: {:.4f}'.format(loss))
-    print('Dev mask loss: {:.4f}'.format(mask_loss))
-    print('Dev regr loss: {:.4f}'.format(regr_loss))
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+# criterion (loss.py) and the train / dev loops live in engine.py
+from engine import train_epoch, evaluate, progressive_schedule
+from profiling import StepProfiler
 
 
 ##########################################################################
 # Training
 ##########################################################################
-import pandas as pd
-import torch
-import gc
-
-
-import torch
-import torch.optim as optim
-from torch.optim import lr_scheduler
-
-
-import os
-import pandas as pd
-from sklearn.model_selection import train_test_split
-from torch.utils.data import DataLoader
-
 PATH = './Dataset/'
 os.listdir(PATH)
 
+# distributed when started through torchrun, single process otherwise
+rank, world_size = init_distributed()
+
+# the split files of splits.py: written once with the unreadable images left out, the same every run
+df_train, df_dev, df_test = load_splits()
+# every labelled image, for the ground plane fit
+train = pd.concat([df_train, df_dev])
+
 debugging_mode=False
 if debugging_mode:
-    train = pd.read_csv(PATH + 'train.csv', nrows=20)
-    test = pd.read_csv(PATH + 'sample_submission.csv',nrows=2)
-else:
-    train = pd.read_csv(PATH + 'train.csv')
-    test = pd.read_csv(PATH + 'sample_submission.csv')
-
-# Remove damaged images from the dataset
-img_damaged = ['ID_1a5a10365', 'ID_4d238ae90.jpg',
-               'ID_408f58e9f', 'ID_bb1d991f6', 'ID_c44983aeb']
-train = train[~train['ImageId'].isin(img_damaged)]
+    df_train, df_dev, df_test = df_train[:20], df_dev[:2], df_test[:2]
 
 train_images_dir = PATH + 'train_images/{}.jpg'
 test_images_dir = PATH + 'test_images/{}.jpg'
 
-# df_train, df_test = train_test_split(train, test_size=0.02, random_state=231)
-# df_train, df_dev = train_test_split(df_train, test_size=0.02, random_state=231)
-
-df_train, df_dev = train_test_split(train, test_size=0.01, random_state=231)
-df_test = test
-
 
-train_dataset = CarDataset(df_train, train_images_dir, training=True)
-dev_dataset = CarDataset(df_dev, train_images_dir, training=False)
+# progressive resizing: early epochs train on smaller images (engine.progressive_schedule),
+# the dev set and the predictions stay at the full 1024x320
+progressive = False
+progressive_scales = (0.5, 0.75, 1.0)
+# preprocessed images cached per resolution (cache.py), None reads the jpgs every epoch
+cache_dir = None
+# dev images and targets computed once and reused by every evaluation (cache.materialize)
+cache_dev = True
+# dev loss on a fixed subsample of eval_subsample dev images every eval_every training steps
+eval_every = None
+eval_subsample = 64
+# train batches with about the same number of cars, and oversampling of the images with a high recent loss
+# (label_index.LabelBatchSampler, single process only)
+balance_car_count = False
+hard_examples = False
+
+train_dataset = CarDataset(df_train, train_images_dir, training=True, cache_dir=cache_dir)
+dev_dataset = CarDataset(df_dev, train_images_dir, training=False, cache_dir=cache_dir)
 # test_dataset = CarDataset(df_test, train_images_dir, training=False)
 test_dataset = CarDataset(df_test, test_images_dir, training=False)
 
 idx, label = train_dataset.df.to_numpy()[0]
 
+if cache_dev:
+    # memmap files next to the dataset when single process, in memory per rank otherwise
+    dev_dataset = materialize(dev_dataset, dev_cache_path(df_dev) if world_size == 1 else None)
+
 
 # BATCH_SIZE = 1
 BATCH_SIZE = 4
 
-train_loader = DataLoader(dataset=train_dataset,
-                          batch_size=BATCH_SIZE, shuffle=True, num_workers=4)
-dev_loader = DataLoader(dataset=dev_dataset,
-                        batch_size=BATCH_SIZE, shuffle=False, num_workers=0)
+train_loader = make_loader(train_dataset, BATCH_SIZE, shuffle=True, num_workers=4)
+if (balance_car_count or hard_examples) and world_size == 1:
+    from label_index import build_label_index, LabelBatchSampler
+    train_sampler = LabelBatchSampler(build_label_index(df_train), BATCH_SIZE, balance_car_count, hard_examples)
+    train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, num_workers=4,
+                              pin_memory=torch.cuda.is_available())
+dev_loader = make_loader(dev_dataset, BATCH_SIZE, shuffle=False, num_workers=2)
+subsample_loader = make_loader(fixed_subsample(dev_dataset, eval_subsample), BATCH_SIZE, shuffle=False,
+                               num_workers=0)
 test_loader = DataLoader(dataset=test_dataset,
-                         batch_size=BATCH_SIZE, shuffle=False, num_workers=0)
+                         batch_size=BATCH_SIZE, shuffle=False, num_workers=0,
+                         pin_memory=torch.cuda.is_available())
 
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+device = get_device()
 # device = torch.device("cpu")
 # print(device)
 
@@ -455,60 +107,78 @@ else:
     n_epochs = 10
 
 read_from_saved_model=False
+# torch.profiler traces of a few steps of the first epoch, the dev pass and the predictions
+# written to ./profiles/ (profiling.py)
+profile = False
+# moving average of the weights (ema.py), used for the dev loss, the predictions and saved with the model
+use_ema = False
+ema_decay = 0.999
+ema = None
 
 if read_from_saved_model:
-    model = torch.load('./model_test_org.pth')
+    # EMA weights when the checkpoint has them
+    model = load_model('./model_test_org.pth', device)
 
 
 else:
-    model = ConvMultiRes(8).to(device)
+    model = wrap_model(ConvMultiRes(8).to(device))
     # optimizer = optim.Adam(model.parameters(), lr=0.001)
     optimizer = optim.Adam(model.parameters(), lr=0.001, weight_decay=0.01)
     exp_lr_scheduler = lr_scheduler.StepLR(optimizer, step_size=max(
         n_epochs, 10) * len(train_loader) // 3, gamma=0.1)
-
+    if use_ema:
+        # updated every 4 steps in a background thread, off the training step
+        ema = ModelEMA(model, ema_decay, every=4, background=True)
 
 
     history = pd.DataFrame()
+    scales = progressive_schedule(n_epochs, progressive_scales if progressive else (1.0,))
 
     for epoch in range(n_epochs):
         torch.cuda.empty_cache()
         gc.collect()
-        train_model(epoch, history)
-        evaluate_model(epoch, history)
+        set_epoch(train_loader, epoch)
+        # the loader workers are started per epoch and pick up the new resolution
+        train_dataset.res = Resolution.scaled(scales[epoch])
+        first = profile and epoch == 0
+        train_epoch(model, train_loader, optimizer, exp_lr_scheduler, device, epoch, history,
+                    profiler=StepProfiler('train', first, model), eval_loader=subsample_loader,
+                    eval_every=eval_every, ema=ema)
+        evaluate(model if ema is None else ema.module, dev_loader, device, epoch, history,
+                 profiler=StepProfiler('dev', first, model, wait=1, warmup=1, active=3))
 
 ##########################################################################
 # Save model
 ##########################################################################
-import torch
-import gc
-import pandas as pd
-from sklearn.linear_model import LinearRegression
+from ground_plane import load_ground_plane
+from decode import predict, decode_batch
+from prefetch import DevicePrefetcher
 
 save_model = True
 make_predictions = True
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# average each test image with its mirror (both views in one forward batch)
+flip_tta = False
+# evaluate the pose head only at the heatmap peaks (not combined with flip_tta)
+sparse_pose = False
+# more checkpoints averaged with this model before the single decode (ensemble.py, not with sparse_pose)
+ensemble_models = []
+device = get_device()
 
 
 if save_model:
-    torch.save(model, './model_test_org.pth')
-
-if make_predictions:
+    if ema is not None:
+        # state dicts of the model and its EMA, model.load_model reads the EMA weights
+        save_on_main(checkpoint(model, ema), './model_test_org.pth')
+    else:
+        save_on_main(unwrap_model(model), './model_test_org.pth')
+model = unwrap_model(model) if ema is None else ema.module
+cleanup()
 
-    points_df = pd.DataFrame()
-    for col in ['x', 'y', 'z', 'yaw', 'pitch', 'roll']:
-        arr = []
-        for ps in train['PredictionString']:
-            coords = label_to_list(ps)
-            arr += [c[col] for c in coords]
-        points_df[col] = arr
+# only rank 0 writes the submission
+if make_predictions and rank == 0:
 
-
-    # Will use this model later
-    xzy_slope = LinearRegression()
-    X = points_df[['x', 'z']]
-    y = points_df['y']
-    xzy_slope.fit(X, y)
+    # Will use this model later, fitted once and cached next to the dataset
+    xzy_slope = load_ground_plane(train['PredictionString'], PATH + 'xzy_slope.json')
 
     torch.cuda.empty_cache()
     gc.collect()
@@ -517,20 +187,30 @@ if make_predictions:
     predictions = []
 
     test_loader = DataLoader(dataset=test_dataset,
-                             batch_size=BATCH_SIZE, shuffle=False, num_workers=4)
+                             batch_size=BATCH_SIZE, shuffle=False, num_workers=4,
+                             pin_memory=torch.cuda.is_available())
 
     model.eval()
-
-    for img, _, _ in tqdm(test_loader):
-        with torch.no_grad():
-            output = model(img.to(device))
-        output = output.data.cpu().numpy()
-        for out in output:
-            coords = get_coord_from_pred(xzy_slope,out, threshold=0)
-            s = coords_to_label(coords)
-            predictions.append(s)
+    if ensemble_models:
+        from ensemble import Ensemble
+        model = Ensemble([model] + [load_model(path, device) for path in ensemble_models]).eval()
+
+    profiler = StepProfiler('predict', profile, model)
+    with profiler:
+        for img, _, _ in profiler.iterate(tqdm(DevicePrefetcher(test_loader, device))):
+            points = None
+            with profiler.phase('forward'):
+                if sparse_pose:
+                    with torch.no_grad():
+                        output, points = model.forward_sparse(img, threshold=0)
+                else:
+                    output = predict(model, img, flip_tta=flip_tta)
+            with profiler.phase('decode'):
+                predictions += decode_batch(output, xzy_slope, threshold=0, points=points)
+            profiler.step()
 
     test = pd.read_csv(PATH + 'sample_submission.csv')
-    test['PredictionString'] = predictions
+    # images left out of the test split (unreadable) get no cars
+    test['PredictionString'] = test['ImageId'].map(dict(zip(df_test['ImageId'], predictions))).fillna('')
     test.to_csv('predictions_org.csv', index=False)
     test.head()
@@ -4,20 +4,45 @@
 import torch
 import numpy as np
 import cv2
-from loading_functions import *
-from helper_functions import *
+from helper_functions import img_preprocess, get_mask_and_pose
+from camera_model import DEFAULT_RESOLUTION, IMG_SHAPE
 
 from torch.utils.data import Dataset
 
 
+def train_dev_split(train, test_size=0.01, random_state=231):
+    # train.csv rows -> (df_train, df_dev); run once by splits.build_splits on the readable
+    # images, the entry points read the resulting split files with splits.load_splits
+    from sklearn.model_selection import train_test_split
+    return train_test_split(train, test_size=test_size, random_state=random_state)
+
+
 class CarDataset(Dataset):
     """Car dataset."""
 
-    def __init__(self, dataframe, root_dir, training=True, transform=None):
+    def __init__(self, dataframe, root_dir, training=True, transform=None, res=DEFAULT_RESOLUTION,
+                 cache_dir=None):
         self.df = dataframe
         self.root_dir = root_dir
         self.transform = transform
         self.training = training
+        # preprocessed images are read from a cache.ImageCache per resolution when cache_dir is set
+        self.cache_dir = cache_dir
+        self._caches = {}
+        self.res = res
+
+    @property
+    def res(self):
+        return self._res
+
+    @res.setter
+    def res(self, res):
+        # network resolution, can change between epochs (progressive resizing)
+        # the cache files are created here, in the main process, before the workers start
+        self._res = res
+        if self.cache_dir is not None and res not in self._caches:
+            from cache import ImageCache
+            self._caches[res] = ImageCache(self.cache_dir, self.df['ImageId'], res)
 
     def __len__(self):
         return len(self.df)
@@ -36,12 +61,17 @@ class CarDataset(Dataset):
             flip = np.random.randint(10) == 1
 
         # Read image
-        img0 = cv2.imread(img_name)
-        img = img_preprocess(img0, flip=flip)
+        if self.cache_dir is not None:
+            img = img_preprocess(self._caches[self.res].get(idx, img_name), flip=flip, cropped=True)
+            # every raw image has the same shape
+            img0 = IMG_SHAPE
+        else:
+            img0 = cv2.imread(img_name)
+            img = img_preprocess(img0, flip=flip, res=self.res)
         img = np.rollaxis(img, 2, 0)
 
         # Get mask and regression maps
-        mask, pose = get_mask_and_pose(img0, labels, flip=flip)
+        mask, pose = get_mask_and_pose(img0, labels, flip=flip, res=self.res)
         pose = np.rollaxis(pose, 2, 0)
 
         return [img, mask, pose]
@@ -0,0 +1,79 @@
+##########################################################################
+# Batched decoding of the network output
+##########################################################################
+import numpy as np
+import torch
+import torch.nn.functional as F
+from helper_functions import get_coord_from_pred, coords_to_label
+
+# output channels: detection logits, then the pose maps in sorted order
+POSE_NAMES = sorted(['x', 'y', 'z', 'yaw', 'pitch_sin', 'pitch_cos', 'roll'])
+# a horizontal flip changes the sign of x, pitch and roll (see pose_preprocess)
+FLIP_SIGN = [1.0] + [-1.0 if n in ('x', 'pitch_sin', 'roll') else 1.0 for n in POSE_NAMES]
+
+
+def flip_output(output):
+    # mirror an output batch [B, 8, H, W] into the other view
+    sign = torch.tensor(FLIP_SIGN, dtype=output.dtype, device=output.device)
+    return output.flip(-1) * sign.view(1, -1, 1, 1)
+
+
+def predict_flip_tta(model, img_batch):
+    # images and their mirrors go through the model in the same batch,
+    # the mirrored half is flipped back and both views are averaged
+    n = img_batch.shape[0]
+    output = model(torch.cat([img_batch, img_batch.flip(-1)], 0))
+    return (output[:n] + flip_output(output[n:])) / 2
+
+
+def predict(model, img_batch, flip_tta=False):
+    with torch.no_grad():
+        if flip_tta:
+            return predict_flip_tta(model, img_batch)
+        return model(img_batch)
+
+
+def extract_peaks(logits, threshold=0, top_k=100, kernel=3):
+    # local maxima of the heatmap for the whole batch: a cell is kept when it equals
+    # the max of its 3x3 neighbourhood, is above threshold and is in the top_k of its image
+    # logits: [B, H, W] (or the full [B, 8, H, W] output)
+    # returns per image an (N, 2) array of (row, col), same layout as np.argwhere, and the N scores
+    if logits.dim() == 4:
+        logits = logits[:, 0]
+    logits = logits.detach().float()
+    batch_size, height, width = logits.shape
+    hmax = F.max_pool2d(logits[:, None], kernel, stride=1, padding=kernel // 2)[:, 0]
+    keep = (logits == hmax) & (logits > threshold)
+    peaks = torch.where(keep, logits, torch.full_like(logits, -float('inf')))
+    scores, idx = peaks.view(batch_size, -1).topk(min(top_k, height * width), dim=1)
+    valid = torch.isfinite(scores).cpu().numpy()
+    rows = (idx // width).cpu().numpy()
+    cols = (idx % width).cpu().numpy()
+    scores = scores.cpu().numpy()
+    points = [np.stack([rows[i][valid[i]], cols[i][valid[i]]], 1) for i in range(batch_size)]
+    return points, [scores[i][valid[i]] for i in range(batch_size)]
+
+
+def decode_coords(output, xzy_slope, threshold=0, top_k=100, points=None):
+    # list of car dicts per image of the batch
+    # only heatmap peaks are refined; top_k=None falls back to every cell above threshold
+    # points: peaks already extracted, e.g. by ConvMultiRes.forward_sparse
+    if points is None:
+        points = [None] * output.shape[0]
+        if top_k is not None:
+            points, _ = extract_peaks(output, threshold, top_k)
+    output = output.data.cpu().numpy()
+    # the network resolution follows from the output grid, see camera_model.Resolution.from_grid
+    return [get_coord_from_pred(xzy_slope, out, threshold=threshold, points=pts)
+            for out, pts in zip(output, points)]
+
+
+def decode_batch(output, xzy_slope, threshold=0, top_k=100, points=None):
+    # one PredictionString per image of the batch
+    return [coords_to_label(coords) for coords in decode_coords(output, xzy_slope, threshold, top_k, points)]
+
+
+def coords_to_json(coords):
+    # JSON friendly detections of one image
+    cars = [{k: float(v) for k, v in c.items()} for c in coords]
+    return {'PredictionString': coords_to_label(coords), 'detections': cars}
@@ -0,0 +1,209 @@
+##########################################################################
+# Knowledge distillation of ConvMultiRes into a narrow student
+#
+#   python distill.py --teacher model_test_org.pth --widths 0.25 0.5 --epochs 2
+#
+# The teacher runs once over the training images and its outputs are cached
+# in a float16 memmap; each student then learns from the ground truth
+# (criterion) and the cached teacher heatmap / pose maps. Writes a
+# throughput vs dev loss table with one row per student width.
+##########################################################################
+import hashlib
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+from loss import criterion, GAMMA
+from distributed import is_main_process
+from prefetch import DevicePrefetcher
+from camera_model import DEFAULT_RESOLUTION
+from cache import CACHE_DIR
+
+
+def teacher_cache_path(teacher_path, image_ids, res=DEFAULT_RESOLUTION, cache_dir=CACHE_DIR):
+    # cache file of the outputs of a teacher checkpoint, keyed by its content, the images and the resolution
+    md5 = hashlib.md5()
+    with open(teacher_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    md5.update('\n'.join(image_ids).encode())
+    return os.path.join(cache_dir, 'teacher_{}_{}.npy'.format(res.name, md5.hexdigest()[:12]))
+
+
+def cache_teacher_outputs(teacher, dataset, path, batch_size=4, device='cpu', num_workers=2):
+    # teacher output [N, 8, H, W] for every item of dataset, written once to a float16 .npy memmap
+    # the dataset must not augment (CarDataset training=False), the cache is indexed by item
+    # path: from teacher_cache_path, so another teacher, image list or resolution gets its own file;
+    # None keeps the outputs in memory
+    if path is not None and os.path.exists(path):
+        cache = np.load(path, mmap_mode='r')
+        if len(cache) == len(dataset):
+            return cache
+    teacher.eval()
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    cache = None
+    n = 0
+    with torch.no_grad():
+        for img_batch, _, _ in tqdm(loader, disable=not is_main_process()):
+            output = teacher(img_batch.to(device)).cpu().numpy()
+            if cache is None:
+                shape = (len(dataset),) + output.shape[1:]
+                if path is None:
+                    cache = np.empty(shape, dtype=np.float16)
+                else:
+                    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                    cache = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float16, shape=shape)
+            cache[n:n + len(output)] = output
+            n += len(output)
+    if path is None:
+        return cache
+    cache.flush()
+    del cache
+    # only complete caches get the real name
+    os.replace(path + '.tmp', path)
+    return np.load(path, mmap_mode='r')
+
+
+class DistillDataset(Dataset):
+    '''items of dataset with the cached teacher output appended'''
+
+    def __init__(self, dataset, teacher_outputs):
+        self.dataset = dataset
+        self.teacher_outputs = teacher_outputs
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        img, mask, regr = self.dataset[idx]
+        return img, mask, regr, np.asarray(self.teacher_outputs[idx], dtype='float32')
+
+
+def distill_loss(prediction, teacher, mask, regr, alpha=0.5, temperature=1.0, gamma=GAMMA):
+    # (1 - alpha) * criterion on the labels + alpha * match the teacher:
+    # BCE against the softened teacher heatmap and L1 on the pose maps weighted by the teacher's confidence
+    _, _, gt_loss = criterion(prediction, mask, regr)
+    soft = torch.sigmoid(teacher[:, 0] / temperature)
+    mask_kd = F.binary_cross_entropy_with_logits(prediction[:, 0] / temperature, soft, reduction='none')
+    mask_kd = mask_kd.mean(0).sum() * temperature ** 2
+    weight = torch.sigmoid(teacher[:, 0])
+    regr_kd = (torch.abs(prediction[:, 1:] - teacher[:, 1:]).sum(1) * weight).sum((1, 2)) / \
+        weight.sum((1, 2)).clamp(min=1e-6)
+    kd_loss = mask_kd + gamma * regr_kd.mean(0)
+    return gt_loss, kd_loss, (1 - alpha) * gt_loss + alpha * kd_loss
+
+
+def distill_epoch(student, loader, optimizer, scheduler=None, device='cpu', epoch=0, history=None,
+                  alpha=0.5, temperature=1.0, verbose=True):
+    # engine.train_epoch with distill_loss, loader yields DistillDataset items
+    student.train()
+    verbose = verbose and is_main_process()
+    batches = DevicePrefetcher(loader, device)
+    for batch_idx, (img_batch, mask_batch, regr_batch, teacher_batch) in enumerate(tqdm(batches, disable=not verbose)):
+        optimizer.zero_grad()
+        output = student(img_batch)
+        gt_loss, kd_loss, loss = distill_loss(output, teacher_batch, mask_batch, regr_batch, alpha, temperature)
+        if history is not None:
+            step = epoch + batch_idx / len(loader)
+            history.loc[step, 'train_loss'] = loss.item()
+            history.loc[step, 'train_gt_loss'] = gt_loss.item()
+            history.loc[step, 'train_kd_loss'] = kd_loss.item()
+
+        loss.backward()
+        optimizer.step()
+        if scheduler is not None:
+            scheduler.step()
+
+    if verbose:
+        print('Distill Epoch: {} \tLR: {:.6f}\tLoss: {:.6f}'.format(
+            epoch, optimizer.param_groups[0]['lr'], loss.item()))
+        print('Train gt loss: {:.4f}'.format(gt_loss))
+        print('Train kd loss: {:.4f}'.format(kd_loss))
+
+
+def width_curve(teacher, train_dataset, dev_loader, widths, backbone=None, epochs=2, batch_size=4,
+                device='cpu', alpha=0.5, temperature=1.0, cache=None, save_dir=None, out=None):
+    # distill one student per width multiplier and compare throughput and dev loss with the teacher
+    # cache: teacher_cache_path of the teacher checkpoint and the train images
+    import pandas as pd
+    from model import ConvMultiRes
+    from engine import evaluate
+    from benchmark import measure_latency
+
+    teacher_outputs = cache_teacher_outputs(teacher, train_dataset, cache, batch_size, device)
+    train_loader = DataLoader(DistillDataset(train_dataset, teacher_outputs), batch_size=batch_size,
+                              shuffle=True, num_workers=2, pin_memory=torch.cuda.is_available())
+    img = next(iter(dev_loader))[0].to(device)
+
+    def row(name, model):
+        model.eval()
+        ms = measure_latency(model, img, repeats=5)['median_ms']
+        return {'model': name,
+                'params_M': sum(p.numel() for p in model.parameters()) / 1e6,
+                'images_per_s': img.shape[0] / ms * 1000,
+                'dev_loss': evaluate(model, dev_loader, device, verbose=False)}
+
+    rows = [row('teacher', teacher)]
+    print(rows[-1])
+    for width in widths:
+        student = ConvMultiRes(8, backbone, widths=(width, width, width)).to(device)
+        optimizer = torch.optim.Adam(student.parameters(), lr=0.001, weight_decay=0.01)
+        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=max(epochs, 10) * len(train_loader) // 3,
+                                                    gamma=0.1)
+        for epoch in range(epochs):
+            distill_epoch(student, train_loader, optimizer, scheduler, device, epoch,
+                          alpha=alpha, temperature=temperature)
+        if save_dir is not None:
+            os.makedirs(save_dir, exist_ok=True)
+            torch.save(student, os.path.join(save_dir, 'student_{}.pth'.format(width)))
+        rows.append(row('student_{}'.format(width), student))
+        rows[-1]['width'] = width
+        print(rows[-1])
+    table = pd.DataFrame(rows)
+    if out is not None:
+        table.to_csv(out, index=False)
+    return table
+
+
+if __name__ == "__main__":
+    import argparse
+    from torch.utils.data import Subset
+    from dataset_class import CarDataset
+    from splits import load_splits
+    from model import load_model
+    parser = argparse.ArgumentParser(description='Distill ConvMultiRes into narrower students')
+    parser.add_argument('--teacher', default='./model_test_org.pth')
+    parser.add_argument('--widths', type=float, nargs='+', default=[0.125, 0.25, 0.5])
+    parser.add_argument('--backbone', default=None, help='student backbone, the teacher one by default')
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--alpha', type=float, default=0.5, help='weight of the teacher term')
+    parser.add_argument('--temperature', type=float, default=1.0)
+    parser.add_argument('--train-images', type=int, default=None)
+    parser.add_argument('--dev-images', type=int, default=None)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--save-dir', default='students/')
+    parser.add_argument('--out', default='distill.csv')
+    args = parser.parse_args()
+
+    PATH = './Dataset/'
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # same split as centernet-final.py
+    df_train, df_dev = load_splits(('train', 'dev'))
+    # no flip augmentation, the teacher cache is per image
+    train_dataset = CarDataset(df_train, PATH + 'train_images/{}.jpg', training=False)
+    dev_dataset = CarDataset(df_dev, PATH + 'train_images/{}.jpg', training=False)
+    if args.train_images:
+        train_dataset = Subset(train_dataset, range(min(args.train_images, len(train_dataset))))
+    if args.dev_images:
+        dev_dataset = Subset(dev_dataset, range(min(args.dev_images, len(dev_dataset))))
+    dev_loader = DataLoader(dev_dataset, batch_size=args.batch, shuffle=False, num_workers=0)
+
+    teacher = load_model(args.teacher, device)
+    image_ids = list(df_train['ImageId'][:len(train_dataset)])
+    cache = teacher_cache_path(args.teacher, image_ids, DEFAULT_RESOLUTION, args.cache_dir)
+    backbone = args.backbone or getattr(teacher, 'backbone', None)
+    print(width_curve(teacher, train_dataset, dev_loader, args.widths, backbone, args.epochs, args.batch,
+                      device, args.alpha, args.temperature, cache, args.save_dir, args.out))
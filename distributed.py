@@ -0,0 +1,152 @@
+##########################################################################
+# Multi-process data-parallel training (torch.distributed, gloo backend)
+#
+# Launch on one box with several local processes, e.g.
+#     torchrun --standalone --nproc_per_node=4 train.py
+#     torchrun --standalone --nproc_per_node=4 centernet-final.py
+# or from python with launch(fn, world_size).
+##########################################################################
+import os
+import socket
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend='gloo'):
+    # join the process group described by the torchrun environment variables
+    # (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT); plain single process otherwise
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1 and not is_distributed():
+        dist.init_process_group(backend)
+        # split the cores between the local processes instead of oversubscribing
+        local_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_size))
+    return get_rank(), get_world_size()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def get_device():
+    # one GPU per local rank if there are any, otherwise everybody on CPU
+    if torch.cuda.is_available():
+        return torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+    return torch.device('cpu')
+
+
+class DistributedEvalSampler(Sampler):
+    '''Strided shard of the dataset for each rank'''
+    '''unlike DistributedSampler there is no padding, so every image is seen once'''
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        self.dataset = dataset
+        self.num_replicas = get_world_size() if num_replicas is None else num_replicas
+        self.rank = get_rank() if rank is None else rank
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.num_replicas))
+
+
+def make_loader(dataset, batch_size, shuffle, num_workers, seed=0):
+    # DataLoader that shards the dataset across ranks when running distributed
+    sampler = None
+    if is_distributed():
+        if shuffle:
+            sampler = DistributedSampler(dataset, shuffle=True, seed=seed)
+        else:
+            sampler = DistributedEvalSampler(dataset)
+    # pinned batches can be copied to the gpu asynchronously (see prefetch.DevicePrefetcher)
+    return DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle and sampler is None,
+                      sampler=sampler, num_workers=num_workers, pin_memory=torch.cuda.is_available())
+
+
+def set_epoch(loader, epoch):
+    # reshuffle the train shards every epoch
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+def wrap_model(model):
+    # the EfficientNet classifier head (_fc) never sees a gradient, hence find_unused_parameters
+    if not is_distributed():
+        return model
+    if next(model.parameters()).is_cuda:
+        return DistributedDataParallel(model, device_ids=[torch.cuda.current_device()],
+                                       find_unused_parameters=True)
+    return DistributedDataParallel(model, find_unused_parameters=True)
+
+
+def unwrap_model(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def all_reduce_sum(*values):
+    # sum losses over all ranks; plain numbers (e.g. a rank without batches) become tensors
+    if not is_distributed():
+        return values
+    out = []
+    for v in values:
+        v = torch.as_tensor(v, dtype=torch.float32).detach().clone()
+        device = v.device
+        v = v.cpu() if dist.get_backend() == 'gloo' else v
+        dist.all_reduce(v, op=dist.ReduceOp.SUM)
+        out.append(v.to(device))
+    return tuple(out)
+
+
+def save_on_main(obj, path):
+    # checkpoint from rank 0 only, the other ranks wait until the file is written
+    if is_main_process():
+        torch.save(obj, path)
+    if is_distributed():
+        dist.barrier()
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _launch_worker(rank, fn, world_size, args):
+    os.environ['RANK'] = str(rank)
+    os.environ['LOCAL_RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+    os.environ['LOCAL_WORLD_SIZE'] = str(world_size)
+    init_distributed()
+    try:
+        fn(*args)
+    finally:
+        cleanup()
+
+
+def launch(fn, world_size, *args):
+    # run fn(*args) in world_size local processes joined in one gloo group
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(_free_port()))
+    mp.spawn(_launch_worker, args=(fn, world_size, args), nprocs=world_size, join=True)
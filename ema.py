@@ -0,0 +1,94 @@
+##########################################################################
+# Exponential moving average of the model weights
+#
+#   ema = ModelEMA(model, decay=0.999, every=4, background=True)
+#   train_epoch(model, loader, optimizer, ema=ema)
+#   evaluate(ema.module, dev_loader)
+#
+# The shadow weights are updated with multi-tensor (torch._foreach) ops,
+# every `every` steps with the decay raised to that power so the averaging
+# horizon in steps does not change. With background=True the update runs
+# in a thread while the next forward / backward pass runs; the optimizer
+# step waits for it (ModelEMA.wait) since it changes the weights it reads.
+##########################################################################
+import copy
+import threading
+import torch
+from distributed import unwrap_model
+
+
+class ModelEMA:
+    '''shadow copy of a model holding the moving average of its weights and buffers'''
+    '''ema.module is a normal eval-mode model for evaluate / predict / decode'''
+
+    def __init__(self, model, decay=0.999, every=1, background=False):
+        self.module = copy.deepcopy(unwrap_model(model)).eval()
+        for p in self.module.parameters():
+            p.requires_grad_(False)
+        self.decay = decay
+        self.every = every
+        self.background = background
+        self.steps = 0
+        self.updates = 0
+        self._thread = None
+
+    def _pairs(self, model):
+        # (ema, model) float tensors to average and the other tensors (BN step counters) to copy
+        # buffers are snapshotted now: the next forward pass updates the BN running stats in place
+        # while a background update may still be reading them; parameters only change in optimizer.step
+        model = unwrap_model(model)
+        ema_state = self.module.state_dict()
+        params = {k for k, _ in model.named_parameters()}
+        floats, others = [], []
+        for k, v in model.state_dict().items():
+            v = v.detach() if k in params else v.clone()
+            (floats if v.dtype.is_floating_point else others).append((ema_state[k], v))
+        return floats, others
+
+    def _apply(self, floats, others, weight):
+        with torch.no_grad():
+            torch._foreach_lerp_([e for e, _ in floats], [m for _, m in floats], weight)
+            for e, m in others:
+                e.copy_(m)
+
+    def update(self, model):
+        # call after every optimizer step
+        self.steps += 1
+        if self.steps % self.every:
+            return
+        self.wait()
+        # short warm up: early weights come from a randomly initialised model
+        decay = min(self.decay, (1 + self.updates) / (10 + self.updates)) ** self.every
+        self.updates += 1
+        floats, others = self._pairs(model)
+        if self.background:
+            self._thread = threading.Thread(target=self._apply, args=(floats, others, 1 - decay), daemon=True)
+            self._thread.start()
+        else:
+            self._apply(floats, others, 1 - decay)
+
+    def wait(self):
+        # block until a background update is done; call before the weights change again
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def state_dict(self):
+        self.wait()
+        return {'module': self.module.state_dict(), 'steps': self.steps, 'updates': self.updates,
+                'decay': self.decay, 'every': self.every}
+
+    def load_state_dict(self, state):
+        self.wait()
+        self.module.load_state_dict(state['module'])
+        self.steps, self.updates = state['steps'], state['updates']
+
+
+def checkpoint(model, ema=None):
+    # state_dict checkpoint with the EMA weights, readable by model.load_model
+    model = unwrap_model(model)
+    state = {'model': model.state_dict(), 'arch': type(model).__name__,
+             'backbone': getattr(model, 'backbone', None), 'widths': getattr(model, 'widths', None)}
+    if ema is not None:
+        state['ema'] = ema.state_dict()
+    return state
@@ -0,0 +1,123 @@
+##########################################################################
+# Training and evaluation loops shared by train.py, centernet-final.py
+# and the benchmark / tuning tools
+##########################################################################
+import torch
+from tqdm import tqdm
+from loss import criterion, per_image_loss, GAMMA
+from distributed import all_reduce_sum, is_main_process
+from prefetch import DevicePrefetcher
+from profiling import StepProfiler
+
+
+def train_epoch(model, loader, optimizer, scheduler=None, device='cpu', epoch=0, history=None,
+                verbose=True, profiler=None, gamma=GAMMA, eval_loader=None, eval_every=None, ema=None):
+    # one pass over loader; scheduler is stepped per batch like the StepLR schedules
+    # gamma: weight of the regression term of criterion
+    # eval_loader / eval_every: dev loss on eval_loader (e.g. a cache.fixed_subsample) every
+    # eval_every steps, in history as subsample_dev_loss
+    # ema: an ema.ModelEMA updated after every optimizer step (and used for the subsample evaluation)
+    # profiler: a profiling.StepProfiler, records a window of the steps when enabled
+    # a batch sampler drawing by loss (label_index.LabelBatchSampler with hard_examples) gets the per-image losses
+    # returns the data-wait stats of DevicePrefetcher
+    model.train()
+    verbose = verbose and is_main_process()
+    profiler = profiler or StepProfiler()
+    # batches arrive on device, the next one is copied while this one runs
+    batches = DevicePrefetcher(loader, device)
+    sampler = loader.batch_sampler
+    record = sampler.record if getattr(sampler, 'hard_examples', False) else None
+    with profiler:
+        for batch_idx, (img_batch, mask_batch, regr_batch) in enumerate(
+                profiler.iterate(tqdm(batches, disable=not verbose))):
+            optimizer.zero_grad()
+            with profiler.phase('forward'):
+                output = model(img_batch)
+            with profiler.phase('loss'):
+                mask_loss, regr_loss, loss = criterion(output, mask_batch, regr_batch, gamma=gamma)
+                if record is not None:
+                    record(per_image_loss(output.detach(), mask_batch, regr_batch, gamma).cpu().numpy())
+            if history is not None:
+                step = epoch + batch_idx / len(loader)
+                history.loc[step, 'train_loss'] = loss.item()
+                history.loc[step, 'train_mask_loss'] = mask_loss.item()
+                history.loc[step, 'train_regr_loss'] = regr_loss.item()
+
+            with profiler.phase('backward'):
+                loss.backward()
+            with profiler.phase('optimizer'):
+                if ema is not None:
+                    # a background EMA update still reading the weights
+                    ema.wait()
+                optimizer.step()
+                if scheduler is not None:
+                    scheduler.step()
+            if ema is not None:
+                ema.update(model)
+            profiler.step()
+            if eval_every and eval_loader is not None and (batch_idx + 1) % eval_every == 0:
+                if ema is not None:
+                    # the background update of this step may still be writing the shadow weights
+                    ema.wait()
+                dev_loss = evaluate(model if ema is None else ema.module, eval_loader, device, verbose=False)
+                if history is not None:
+                    history.loc[epoch + (batch_idx + 1) / len(loader), 'subsample_dev_loss'] = dev_loss
+                model.train()
+
+    if verbose:
+        print('Train Epoch: {} \tLR: {:.6f}\tLoss: {:.6f}'.format(
+            epoch, optimizer.param_groups[0]['lr'], loss.item()))
+        print('Train mask loss: {:.4f}'.format(mask_loss))
+        print('Train regr loss: {:.4f}'.format(regr_loss))
+        print('Train data wait: {wait_fraction:.1%} of the epoch, {mean_wait_ms:.1f}ms per step'.format(
+            **batches.stats()))
+    if ema is not None:
+        ema.wait()
+    return batches.stats()
+
+
+def evaluate(model, loader, device='cpu', epoch=0, history=None, verbose=True, profiler=None, gamma=GAMMA):
+    # mean dev loss per image, summed over all ranks when distributed
+    model.eval()
+    loss = 0
+    mask_loss = 0
+    regr_loss = 0
+    profiler = profiler or StepProfiler()
+
+    batches = DevicePrefetcher(loader, device)
+    with torch.no_grad(), profiler:
+        for img_batch, mask_batch, regr_batch in profiler.iterate(batches):
+            with profiler.phase('forward'):
+                output = model(img_batch)
+            with profiler.phase('loss'):
+                mask_loss_t, regr_loss_t, loss_t = criterion(output, mask_batch, regr_batch, size_average=False,
+                                                                   gamma=gamma)
+            mask_loss += mask_loss_t
+            regr_loss += regr_loss_t
+            loss += loss_t
+            profiler.step()
+
+    # every rank evaluated its own shard of the dev set
+    mask_loss, regr_loss, loss = all_reduce_sum(mask_loss, regr_loss, loss)
+    loss = float(loss) / len(loader.dataset)
+
+    if history is not None:
+        history.loc[epoch, 'dev_loss'] = loss
+        history.loc[epoch, 'dev_mask_loss'] = float(mask_loss)
+        history.loc[epoch, 'dev_regr_loss'] = float(regr_loss)
+
+    if verbose and is_main_process():
+        print('Dev loss: {:.4f}'.format(loss))
+        print('Dev mask loss: {:.4f}'.format(mask_loss))
+        print('Dev regr loss: {:.4f}'.format(regr_loss))
+        print('Dev data wait: {wait_fraction:.1%}'.format(**batches.stats()))
+    return loss
+
+
+def progressive_schedule(epochs, scales=(0.5, 0.75, 1.0)):
+    # input scale of every epoch for progressive resizing: the first half of the epochs
+    # steps through the low scales, the rest (at least the last epoch) runs at scales[-1]
+    low = scales[:-1]
+    n_low = epochs // 2
+    schedule = [low[i * len(low) // n_low] for i in range(n_low)] if low and n_low > 0 else []
+    return schedule + [scales[-1]] * (epochs - len(schedule))
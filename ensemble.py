@@ -0,0 +1,164 @@
+##########################################################################
+# Ensemble inference over several checkpoints
+#
+#   python ensemble.py --models double_conv.pth multires.pth --out predictions_ensemble.csv
+#   python ensemble.py --models a.pth b.pth c.pth --parallel      # one CPU process per model
+#
+# Every batch is read and preprocessed once, all member models run on it,
+# their outputs (detection logits and pose maps) are averaged and the
+# result is decoded once. Members can be any architecture with the
+# [B, 8, H, W] output (MyUNet, ConvMultiRes, pruned / distilled models).
+##########################################################################
+import os
+import torch
+import torch.nn as nn
+from model import load_model
+
+
+def _average(outputs, weights):
+    return sum(w * out for w, out in zip(weights, outputs)) / sum(weights)
+
+
+class Ensemble(nn.Module):
+    '''weighted mean of the outputs of the member models, run one after the other'''
+    '''a drop-in model for decode.predict, flip TTA and forward hooks'''
+
+    def __init__(self, models, weights=None):
+        super(Ensemble, self).__init__()
+        self.members = nn.ModuleList(models)
+        self.weights = list(weights) if weights is not None else [1.0] * len(models)
+
+    def forward(self, x):
+        return _average([model(x) for model in self.members], self.weights)
+
+
+def _member_worker(path, num_threads, optimize, inputs, outputs):
+    # one member model in its own process: batches in, outputs back, None stops it
+    torch.set_num_threads(num_threads)
+    try:
+        model = load_model(path)
+        if optimize:
+            from optimize import optimize_for_inference
+            optimize_for_inference(model)
+        outputs.put('ready')
+    except Exception as e:
+        outputs.put(e)
+        return
+    while True:
+        img = inputs.get()
+        if img is None:
+            break
+        try:
+            with torch.no_grad():
+                outputs.put(model(img))
+        except Exception as e:
+            outputs.put(e)
+
+
+class ProcessEnsemble:
+    '''Ensemble with every member model in a CPU worker process'''
+    '''the batch goes to shared memory once and the members run concurrently, num_threads each'''
+
+    def __init__(self, paths, weights=None, num_threads=None, optimize=False):
+        import torch.multiprocessing as mp
+        ctx = mp.get_context('spawn')
+        self.weights = list(weights) if weights is not None else [1.0] * len(paths)
+        num_threads = num_threads or max(1, (os.cpu_count() or 1) // len(paths))
+        self.inputs = [ctx.Queue() for _ in paths]
+        self.outputs = [ctx.Queue() for _ in paths]
+        self.workers = [ctx.Process(target=_member_worker, args=(path, num_threads, optimize, i, o), daemon=True)
+                        for path, i, o in zip(paths, self.inputs, self.outputs)]
+        for worker in self.workers:
+            worker.start()
+        try:
+            self._gather()
+        except Exception:
+            self.close()
+            raise
+
+    def _gather(self):
+        results = [q.get() for q in self.outputs]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def __call__(self, x):
+        x = x.cpu().share_memory_()
+        for q in self.inputs:
+            q.put(x)
+        return _average(self._gather(), self.weights)
+
+    def eval(self):
+        # the members are loaded in eval mode
+        return self
+
+    def close(self):
+        for q in self.inputs:
+            q.put(None)
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_ensemble(paths, device='cpu', weights=None, parallel=False, optimize=False):
+    # one model for a single path, otherwise an Ensemble (or ProcessEnsemble on CPU with parallel)
+    if parallel and len(paths) > 1 and torch.device(device).type == 'cpu':
+        return ProcessEnsemble(paths, weights, optimize=optimize)
+    models = [load_model(path, device) for path in paths]
+    if optimize:
+        from optimize import optimize_for_inference
+        models = [optimize_for_inference(model) for model in models]
+    return models[0] if len(models) == 1 else Ensemble(models, weights).eval()
+
+
+if __name__ == "__main__":
+    import argparse
+    import pandas as pd
+    from torch.utils.data import DataLoader
+    from tqdm import tqdm
+    from dataset_class import CarDataset
+    from decode import predict, decode_batch
+    from ground_plane import load_ground_plane, GROUND_PLANE_FILE
+    from prefetch import DevicePrefetcher
+    from splits import load_splits
+    parser = argparse.ArgumentParser(description='Average several models on the test set and decode once')
+    parser.add_argument('--models', nargs='+', required=True)
+    parser.add_argument('--weights', type=float, nargs='+', default=None, help='one per model, equal by default')
+    parser.add_argument('--parallel', action='store_true', help='run each model in its own CPU process')
+    parser.add_argument('--optimize', action='store_true', help='optimize.optimize_for_inference every model')
+    parser.add_argument('--flip-tta', action='store_true')
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--ground-plane', default=GROUND_PLANE_FILE)
+    parser.add_argument('--out', default='predictions_ensemble.csv')
+    args = parser.parse_args()
+
+    PATH = './Dataset/'
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # the readable test images of the split manifest (splits.py)
+    test, = load_splits(('test',))
+    test_loader = DataLoader(CarDataset(test, PATH + 'test_images/{}.jpg', training=False),
+                             batch_size=args.batch, shuffle=False, num_workers=4,
+                             pin_memory=torch.cuda.is_available())
+    xzy_slope = load_ground_plane(path=args.ground_plane)
+    model = load_ensemble(args.models, device, args.weights, args.parallel, args.optimize)
+    predictions = []
+    try:
+        for img, _, _ in tqdm(DevicePrefetcher(test_loader, device)):
+            output = predict(model, img, flip_tta=args.flip_tta)
+            predictions += decode_batch(output, xzy_slope, threshold=0)
+    finally:
+        if isinstance(model, ProcessEnsemble):
+            model.close()
+    submission = pd.read_csv(PATH + 'sample_submission.csv')
+    # images left out of the test split (unreadable) get no cars
+    submission['PredictionString'] = submission['ImageId'].map(dict(zip(test['ImageId'], predictions))).fillna('')
+    submission.to_csv(args.out, index=False)
+    print('{} images -> {}'.format(len(submission), args.out))
@@ -0,0 +1,80 @@
+##########################################################################
+# Ground plane y = a * x + b * z + c fitted on the train labels
+##########################################################################
+import hashlib
+import json
+import os
+import numpy as np
+
+GROUND_PLANE_FILE = 'Dataset/xzy_slope.json'
+
+
+def labels_to_array(prediction_strings):
+    # parse every label string once into an (n_cars, 7) array
+    # columns: id, yaw, pitch, roll, x, y, z
+    values = ' '.join(s for s in prediction_strings if isinstance(s, str)).split()
+    return np.array(values, dtype='float64').reshape([-1, 7])
+
+
+def labels_hash(prediction_strings):
+    md5 = hashlib.md5()
+    for s in prediction_strings:
+        if isinstance(s, str):
+            md5.update(s.encode())
+    return md5.hexdigest()
+
+
+class GroundPlane:
+    '''y = coef_[0] * x + coef_[1] * z + intercept_'''
+    '''same attribute names as sklearn LinearRegression so both can be used in optimize_xy'''
+
+    def __init__(self, coef, intercept, labels_md5=None):
+        self.coef_ = np.asarray(coef, dtype='float64')
+        self.intercept_ = float(intercept)
+        self.labels_md5 = labels_md5
+
+    def __call__(self, x, z):
+        return self.coef_[0] * x + self.coef_[1] * z + self.intercept_
+
+    def predict(self, X):
+        X = np.asarray(X, dtype='float64')
+        return self(X[:, 0], X[:, 1])
+
+    def save(self, path=GROUND_PLANE_FILE):
+        with open(path, 'w') as f:
+            json.dump({'coef': self.coef_.tolist(), 'intercept': self.intercept_,
+                       'labels_md5': self.labels_md5}, f)
+
+    @classmethod
+    def load(cls, path=GROUND_PLANE_FILE):
+        with open(path) as f:
+            d = json.load(f)
+        return cls(d['coef'], d['intercept'], d.get('labels_md5'))
+
+
+def fit_ground_plane(prediction_strings):
+    # least squares fit of the car height y over (x, z)
+    from sklearn.linear_model import LinearRegression
+    cars = labels_to_array(prediction_strings)
+    xzy_slope = LinearRegression()
+    xzy_slope.fit(cars[:, [4, 6]], cars[:, 5])
+    return GroundPlane(xzy_slope.coef_, xzy_slope.intercept_, labels_hash(prediction_strings))
+
+
+def load_ground_plane(prediction_strings=None, path=GROUND_PLANE_FILE):
+    # read the cached fit; refit and save it when missing or the labels changed
+    if os.path.exists(path):
+        plane = GroundPlane.load(path)
+        if prediction_strings is None or plane.labels_md5 == labels_hash(prediction_strings):
+            return plane
+    if prediction_strings is None:
+        raise FileNotFoundError('No ground plane at {}, pass the labels to fit it'.format(path))
+    plane = fit_ground_plane(prediction_strings)
+    plane.save(path)
+    return plane
+
+
+if __name__ == "__main__":
+    import pandas as pd
+    train = pd.read_csv('Dataset/train.csv')
+    print(vars(load_ground_plane(train['PredictionString'])))
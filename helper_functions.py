@@ -3,15 +3,12 @@
 ##########################################################################
 import numpy as np
 import cv2
-from scipy.optimize import minimize
 from math import sin, cos
-from loading_functions import *
+from loading_functions import label_to_list, rotate, get_img_coords
+from camera_model import load_camera, Resolution, IMG_SHAPE, IMG_WIDTH, IMG_HEIGHT, MODEL_SCALE, \
+    DEFAULT_RESOLUTION
 
-
-IMG_WIDTH = 1024
-# IMG_WIDTH = (1024*2)
-IMG_HEIGHT = IMG_WIDTH // 16 * 5
-MODEL_SCALE = 8
+# the network resolution is a parameter (camera_model.Resolution), 1024x320 by default
 
 
 def pose_preprocess(pose_dict, flip=False):
@@ -44,40 +41,42 @@ def pose_reverse(pose_dict):
     return pose_dict
 
 
-def img_preprocess(img, flip=False):
-    # preprocess the image
+def crop_and_resize(img, res=DEFAULT_RESOLUTION):
     # 1. cut the sky part
     # 2. pad the image with the horizontal avg in case the car center is outside image
+    # 3. resize to the network resolution, still uint8 (what cache.ImageCache stores)
     img = img[img.shape[0] // 2:]
 
     side_padding = np.ones_like(img) * img.mean(1, keepdims=True).astype(img.dtype)
     side_padding = side_padding[:, :img.shape[1] // 6]
     img = np.concatenate([side_padding, img, side_padding], 1)
-    img = cv2.resize(img, (IMG_WIDTH, IMG_HEIGHT))
+    return cv2.resize(img, (res.img_width, res.img_height))
+
+
+def img_preprocess(img, flip=False, res=DEFAULT_RESOLUTION, cropped=False):
+    # preprocess the image: crop_and_resize (unless already cropped), flip, scale to [0, 1]
+    if not cropped:
+        img = crop_and_resize(img, res)
     if flip:
         img = img[:, ::-1]
     return (img / 255).astype('float32')
 
 
-def get_mask_and_pose(img, labels, flip=False):
+def get_mask_and_pose(img, labels, flip=False, res=DEFAULT_RESOLUTION):
     # create a mask of img with the 0/1.
     # 1 indicates the there is a car in that pixel
     # create a pose mask of img
     # store the state information for each pixel
-    mask = np.zeros([IMG_HEIGHT // MODEL_SCALE, IMG_WIDTH //
-                     MODEL_SCALE], dtype='float32')
-    pose_names = ['x', 'y', 'z', 'yaw', 'pitch', 'roll']
-    pose = np.zeros([IMG_HEIGHT // MODEL_SCALE, IMG_WIDTH //
-                     MODEL_SCALE, 7], dtype='float32')
+    # img: the raw image or just its shape
+    img_shape = img if isinstance(img, tuple) else img.shape
+    grid_h, grid_w = res.grid
+    mask = np.zeros([grid_h, grid_w], dtype='float32')
+    pose = np.zeros([grid_h, grid_w, 7], dtype='float32')
     coords = label_to_list(labels)
     xs, ys = get_img_coords(labels)
-    for x, y, pose_dict in zip(xs, ys, coords):
-        x, y = y, x
-        x = (x - img.shape[0] // 2) * IMG_HEIGHT / (img.shape[0] // 2) / MODEL_SCALE
-        x = np.round(x).astype('int')
-        y = (y + img.shape[1] // 6) * IMG_WIDTH / (img.shape[1] * 4/3) / MODEL_SCALE
-        y = np.round(y).astype('int')
-        if 0 <= x < IMG_HEIGHT // MODEL_SCALE and 0 <= y < IMG_WIDTH // MODEL_SCALE:
+    rows, cols = load_camera().to_grid(xs, ys, img_shape, *res)
+    for x, y, pose_dict in zip(np.round(rows).astype('int'), np.round(cols).astype('int'), coords):
+        if 0 <= x < grid_h and 0 <= y < grid_w:
             mask[x, y] = 1
             pose_dict = pose_preprocess(pose_dict, flip)
             pose[x, y] = [pose_dict[n] for n in sorted(pose_dict)]
@@ -87,25 +86,26 @@ def get_mask_and_pose(img, labels, flip=False):
 #     print(xs)
     return mask, pose
 
-def convert_3d_to_2d(x, y, z, fx=2304.5479, fy=2305.8757, cx=1686.2379, cy=1354.9849):
+def convert_3d_to_2d(x, y, z):
     # use camera matrix to get the coordinates on image
-    return x * fx / z + cx, y * fy / z + cy
+    return load_camera().project_xyz(x, y, z)
 
 
-def optimize_xy(xzy_slope, r, c, x0, y0, z0, flipped=False):
+def optimize_xy(xzy_slope, r, c, x0, y0, z0, flipped=False, res=DEFAULT_RESOLUTION):
+    # scipy is only needed when decoding, not on import
+    from scipy.optimize import minimize
     # get the real x, y, z from the image based on the fit
-    IMG_SHAPE = (2710, 3384, 3)
+    camera = load_camera()
+    # evaluate the plane with plain arithmetic, sklearn predict is slow inside Powell
+    a, b = xzy_slope.coef_
+    intercept = xzy_slope.intercept_
 
     def distance_fn(xyz):
         x, y, z = xyz
         xx = -x if flipped else x
-        slope_err = (xzy_slope.predict([[xx, z]])[0] - y)**2
-        x, y = convert_3d_to_2d(x, y, z)
-        y, x = x, y
-        x = (x - IMG_SHAPE[0] // 2) * IMG_HEIGHT / \
-            (IMG_SHAPE[0] // 2) / MODEL_SCALE
-        y = (y + IMG_SHAPE[1] // 6) * IMG_WIDTH / \
-            (IMG_SHAPE[1] * 4 / 3) / MODEL_SCALE
+        slope_err = (a * xx + b * z + intercept - y)**2
+        u, v = camera.project_xyz(x, y, z)
+        x, y = camera.to_grid(u, v, IMG_SHAPE, *res)
         return max(0.2, (x-r)**2 + (y-c)**2) + max(0.4, slope_err)
 
     res = minimize(distance_fn, [x0, y0, z0], method='Powell')
@@ -126,11 +126,15 @@ def remove_neighbors(coords, dist_thresh_clear=2):
     return [c for c in coords if c['confidence'] > 0]
 
 
-def get_coord_from_pred(xzy_slope, prediction, flipped=False, threshold=0):
+def get_coord_from_pred(xzy_slope, prediction, flipped=False, threshold=0, points=None, res=None):
     # get the real world coordinate from the prediction in the image
+    # points: candidate (row, col) cells, e.g. from decode.extract_peaks; default every cell above threshold
+    # res: network resolution, by default the one whose output grid matches prediction
+    res = res or Resolution.from_grid(prediction.shape[-2:])
     logits = prediction[0]
     pose_output = prediction[1:]
-    points = np.argwhere(logits > threshold)
+    if points is None:
+        points = np.argwhere(logits > threshold)
     col_names = sorted(
         ['x', 'y', 'z', 'yaw', 'pitch_sin', 'pitch_cos', 'roll'])
     coords = []
@@ -141,7 +145,7 @@ def get_coord_from_pred(xzy_slope, prediction, flipped=False, threshold=0):
         coords[-1]['x'], coords[-1]['y'], coords[-1]['z'] = optimize_xy(xzy_slope, r, c,
                                                                         coords[-1]['x'],
                                                                         coords[-1]['y'],
-                                                                        coords[-1]['z'], flipped)
+                                                                        coords[-1]['z'], flipped, res)
     coords = remove_neighbors(coords)
     return coords
 
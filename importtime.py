@@ -0,0 +1,79 @@
+##########################################################################
+# Import-time budget for the entry points
+#
+#   python importtime.py            # check every module in BUDGETS
+#   python importtime.py server -v  # one module, with the slowest imports
+#
+# Each module is imported in a fresh `python -X importtime` process. The
+# check fails (exit code 1) when the cumulative import time exceeds the
+# budget or when a heavy optional dependency is imported eagerly.
+##########################################################################
+import os
+import re
+import subprocess
+import sys
+
+# cumulative import time budget in seconds; torch alone is most of it
+BUDGETS = {
+    'train': 3.0,
+    'engine': 3.0,
+    'model': 3.0,
+    'decode': 3.0,
+    'server': 3.0,
+    'stream': 3.0,
+    'render': 3.0,
+    'benchmark': 3.0,
+}
+# only needed for plotting, fitting, decoding or one backbone: import them where they are used
+LAZY = ('matplotlib', 'sklearn', 'scipy', 'efficientnet_pytorch', 'torchvision')
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def import_times(module):
+    # {imported module: (self us, cumulative us)} for a fresh `import module`
+    root = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError('import {} failed:\n{}'.format(module, result.stderr[-2000:]))
+    times = {}
+    for line in result.stderr.splitlines():
+        m = _LINE.match(line)
+        if m:
+            times[m.group(4)] = (int(m.group(1)), int(m.group(2)))
+    return times
+
+
+def check(module, budget, verbose=False, top=10):
+    # list of problems, empty when the module is within budget
+    times = import_times(module)
+    total = times[module][1] / 1e6
+    eager = sorted(name for name in times if name.split('.')[0] in LAZY and '.' not in name)
+    print('{:<12s}{:6.2f}s / {:.2f}s{}'.format(module, total, budget,
+                                                '  eager: ' + ', '.join(eager) if eager else ''))
+    if verbose:
+        for name, (_, cumulative) in sorted(times.items(), key=lambda t: -t[1][1])[1:top + 1]:
+            print('    {:8.1f}ms  {}'.format(cumulative / 1e3, name))
+    problems = []
+    if total > budget:
+        problems.append('{} imports in {:.2f}s, budget {:.2f}s'.format(module, total, budget))
+    if eager:
+        problems.append('{} imports {} at module level'.format(module, ', '.join(eager)))
+    return problems
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Check the import time of the entry points')
+    parser.add_argument('modules', nargs='*', default=sorted(BUDGETS))
+    parser.add_argument('--budget', type=float, default=None, help='override the budget in seconds')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the slowest imports')
+    args = parser.parse_args()
+
+    problems = []
+    for module in args.modules:
+        budget = args.budget if args.budget is not None else BUDGETS.get(module, 3.0)
+        problems += check(module, budget, args.verbose)
+    for problem in problems:
+        print('FAIL', problem)
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,144 @@
+##########################################################################
+# Per-image label index and the batch sampler built on it
+#
+#   index = build_label_index(df_train)
+#   sampler = LabelBatchSampler(index, BATCH_SIZE, balance=True, hard_examples=True)
+#   train_loader = DataLoader(train_dataset, batch_sampler=sampler, num_workers=4)
+#   train_epoch(model, train_loader, optimizer)      # feeds sampler.record (hard_examples)
+#
+#   python label_index.py --out Dataset/label_index.csv
+#
+# The index has one row per image with its car count, depth range and how
+# many of its cars make it onto the output grid: car_center / get_mask_and_pose
+# drop the cars that fall outside the grid and keep only the last car of a
+# cell shared by several. The sampler deals the images into batches with the
+# same total number of cars and can oversample the images whose recent loss
+# is high; the per-image losses come from train_epoch (loss.per_image_loss).
+##########################################################################
+import collections
+import numpy as np
+import pandas as pd
+from torch.utils.data import Sampler
+from camera_model import load_camera, IMG_SHAPE, DEFAULT_RESOLUTION
+from ground_plane import labels_to_array
+
+INDEX_COLUMNS = ['ImageId', 'n_cars', 'n_in_grid', 'n_visible', 'n_dropped', 'z_min', 'z_median', 'z_max']
+
+
+def image_label_stats(labels, res=DEFAULT_RESOLUTION, camera=None):
+    # car count, grid visibility and depth range of one label string
+    camera = camera or load_camera()
+    cars = labels_to_array([labels])
+    u, v = camera.project_xyz(cars[:, 4], cars[:, 5], cars[:, 6])
+    rows, cols = camera.to_grid(u, v, IMG_SHAPE, *res)
+    rows, cols = np.round(rows).astype('int'), np.round(cols).astype('int')
+    grid_h, grid_w = res.grid
+    inside = (rows >= 0) & (rows < grid_h) & (cols >= 0) & (cols < grid_w)
+    # a cell holds one car, the others of that cell are overwritten
+    n_visible = len(set(zip(rows[inside], cols[inside])))
+    z = cars[:, 6]
+    return dict(n_cars=len(cars), n_in_grid=int(inside.sum()), n_visible=n_visible,
+                n_dropped=len(cars) - n_visible, z_min=z.min() if len(z) else np.nan,
+                z_median=np.median(z) if len(z) else np.nan, z_max=z.max() if len(z) else np.nan)
+
+
+def build_label_index(df, res=DEFAULT_RESOLUTION):
+    # one row of image_label_stats per row of df, in the same order
+    camera = load_camera()
+    rows = [dict(ImageId=img_id, **image_label_stats(labels, res, camera))
+            for img_id, labels in zip(df['ImageId'], df['PredictionString'])]
+    return pd.DataFrame(rows, columns=INDEX_COLUMNS)
+
+
+class LabelBatchSampler(Sampler):
+    '''batches of dataset indices balanced by car count and / or weighted by recent loss'''
+    '''the DataLoader batch_sampler of a dataset built on the same df as the index'''
+
+    def __init__(self, index, batch_size, balance=True, hard_examples=False, uniform=0.5, power=1.0,
+                 momentum=0.9, drop_last=False, seed=0):
+        # index: build_label_index output; balance: every batch gets about the same number of cars,
+        # the images are dealt to ceil(n / batch_size) batches so many come out one smaller than
+        # batch_size (10 images at batch_size 4: 3, 3 and 4)
+        # hard_examples: an epoch is a weighted draw (with replacement), uniform of the probability mass is
+        # spread evenly and the rest goes with loss ** power, the loss of an image being a moving
+        # average (momentum) of the losses passed to record
+        self.counts = index['n_visible'].to_numpy()
+        self.batch_size = batch_size
+        self.balance = balance
+        self.hard_examples = hard_examples
+        self.uniform = uniform
+        self.power = power
+        self.momentum = momentum
+        self.drop_last = drop_last
+        self.rng = np.random.RandomState(seed)
+        self.losses = np.full(len(self.counts), np.nan)
+        # batches handed to the loader whose losses were not recorded yet, oldest first
+        self._pending = collections.deque()
+
+    def __len__(self):
+        n = len(self.counts)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+    def probabilities(self):
+        # sampling probability of every image for the next hard example epoch
+        n = len(self.losses)
+        seen = ~np.isnan(self.losses)
+        # images without a loss yet count as average ones
+        losses = np.where(seen, self.losses, self.losses[seen].mean() if seen.any() else 1.0)
+        weights = np.maximum(losses, 0) ** self.power
+        total = weights.sum()
+        if total <= 0:
+            return np.full(n, 1.0 / n)
+        return self.uniform / n + (1 - self.uniform) * weights / total
+
+    def _batches(self, indices):
+        n_batches = len(indices) // self.batch_size if self.drop_last else -(-len(indices) // self.batch_size)
+        indices = indices[:n_batches * self.batch_size]
+        if not self.balance:
+            return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        # most cars first (ties in random order), dealt out to the batches back and forth
+        order = indices[np.argsort(-self.counts[indices], kind='stable')]
+        k = np.arange(len(order))
+        batch = np.where(k // n_batches % 2 == 0, k % n_batches, n_batches - 1 - k % n_batches)
+        return [order[batch == b] for b in range(n_batches)]
+
+    def __iter__(self):
+        n = len(self.counts)
+        if self.hard_examples:
+            indices = self.rng.choice(n, n, p=self.probabilities())
+        else:
+            indices = self.rng.permutation(n)
+        batches = self._batches(self.rng.permutation(indices))
+        # a loop that stopped early leaves batches that never reached the model
+        self._pending.clear()
+        for b in self.rng.permutation(len(batches)):
+            if self.hard_examples:
+                self._pending.append(batches[b])
+            yield batches[b].tolist()
+
+    def record(self, losses):
+        # per-image losses of the oldest batch not recorded yet (the loader keeps the batch order);
+        # only read by hard_examples, train_epoch does not compute them otherwise
+        if not self.hard_examples:
+            return
+        indices = self._pending.popleft()
+        losses = np.asarray(losses, dtype='float64')
+        old = self.losses[indices]
+        self.losses[indices] = np.where(np.isnan(old), losses, self.momentum * old + (1 - self.momentum) * losses)
+
+
+if __name__ == "__main__":
+    import argparse
+    from camera_model import Resolution
+    parser = argparse.ArgumentParser(description='Car count, depth range and grid visibility of every train image')
+    parser.add_argument('--labels', default='./Dataset/train.csv')
+    parser.add_argument('--scale', type=float, default=1.0, help='input resolution, x 1024x320')
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args()
+
+    index = build_label_index(pd.read_csv(args.labels), Resolution.scaled(args.scale))
+    print(index.describe().to_string())
+    print('{} of {} cars are not on the {}x{} grid'.format(index['n_dropped'].sum(), index['n_cars'].sum(),
+                                                           *Resolution.scaled(args.scale).grid))
+    if args.out:
+        index.to_csv(args.out, index=False)
@@ -1,35 +1,32 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from sklearn.model_selection import train_test_split
 # from visualize import plt_cars
-from torch.utils.data import DataLoader
 from ImageDataset import ImageDataset
+from distributed import make_loader
+from cache import materialize
+from splits import load_splits
+from camera_model import load_camera
 import time
 PATH = 'Dataset/'
 
 
 def camera():
     # read the camera information and return its camera matrix
-    f = open(PATH + 'camera/camera_intrinsic.txt', 'r')
-    fx = float(f.readline().split()[2][:-1])
-    fy = float(f.readline().split()[2][:-1])
-    cx = float(f.readline().split()[2][:-1])
-    cy = float(f.readline().split()[2][:-1])
-    camera_mat = np.array([[fx, 0, cx],
-                          [0, fy, cy],
-                          [0, 0, 1]], dtype=np.float32)
-    return camera_mat
+    # the txt file is parsed once, see camera_model.load_camera
+    return load_camera(PATH + 'camera/camera_intrinsic.txt').matrix
 
 
-def load_data(input, batch=4):
+def load_data(batch=4):
+    # the train / dev split files of splits.py, written once with the unreadable images left out
     camera_mat = camera()
     train_dir = PATH + 'train_images/'
-    train, validate = train_test_split(input, test_size=0.01, random_state=13)
+    train, validate = load_splits(('train', 'dev'))
     train_data = ImageDataset(train, train_dir, camera_mat)
-    validate_data = ImageDataset(validate, train_dir, camera_mat)
-    train_loader = DataLoader(dataset=train_data, batch_size=batch, shuffle=True, num_workers=2)
-    validate_loader = DataLoader(dataset=validate_data, batch_size=batch, shuffle=False, num_workers=0)
+    # the validation images and targets are computed once, not every epoch
+    validate_data = materialize(ImageDataset(validate, train_dir, camera_mat))
+    # sharded across ranks when running distributed
+    train_loader = make_loader(train_data, batch, shuffle=True, num_workers=2)
+    validate_loader = make_loader(validate_data, batch, shuffle=False, num_workers=2)
     return train_loader, validate_loader, validate_data, validate
 
 
@@ -38,6 +35,7 @@ def train_data_test(filename):
     return train
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
     idx = 2
     t1 = time.time()
     data = train_data_test('train.csv')
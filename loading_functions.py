@@ -4,6 +4,9 @@
 import numpy as np
 import cv2
 from math import sin, cos
+from camera_model import load_camera
+from render import draw_cars
+from rotation import euler_to_rot_batch
 
 
 def label_to_list(s):
@@ -27,36 +30,16 @@ def rotate(x, y):
 
 def get_img_coords(s):
     # from label string to img coordinate
-    # read from txt file
-    camera_matrix = np.array([[2304.5479, 0,  1686.2379],
-                          [0, 2305.8757, 1354.9849],
-                          [0, 0, 1]], dtype=np.float32)
-
     coords = label_to_list(s)
-    xs = [c['x'] for c in coords]
-    ys = [c['y'] for c in coords]
-    zs = [c['z'] for c in coords]
-    P = np.array(list(zip(xs, ys, zs))).T
-    img_mat = np.dot(camera_matrix, P).T
-    img_mat[:, 0] /= img_mat[:, 2]
-    img_mat[:, 1] /= img_mat[:, 2]
-    row = img_mat[:, 0]
-    col = img_mat[:, 1]
+    P = np.array([[c['x'], c['y'], c['z']] for c in coords]).reshape([-1, 3])
+    row, col = load_camera().project_xyz(P[:, 0], P[:, 1], P[:, 2])
     return row, col
 
 
 def euler_to_rot(yaw, pitch, roll):
     # from real world coordinate angle to image coordinate
-    Y = np.array([[cos(yaw), 0, sin(yaw)],
-                  [0, 1, 0],
-                  [-sin(yaw), 0, cos(yaw)]])
-    P = np.array([[1, 0, 0],
-                  [0, cos(pitch), -sin(pitch)],
-                  [0, sin(pitch), cos(pitch)]])
-    R = np.array([[cos(roll), -sin(roll), 0],
-                  [sin(roll), cos(roll), 0],
-                  [0, 0, 1]])
-    return np.dot(Y, np.dot(P, R))
+    # also takes arrays of angles and returns an Nx3x3 stack, see rotation.py
+    return euler_to_rot_batch(yaw, pitch, roll)
 
 
 def draw_line(image, pts):
@@ -91,38 +74,5 @@ def draw_points(image, pts):
 
 def visualize(img, coords):
     # plot the car in the image with a box and a center point
-    # tuning these numbers for a ideal car size
-    x_l = 1.02
-    y_l = 0.80
-    z_l = 2.31
-
-    camera_matrix = np.array([[2304.5479, 0,  1686.2379],
-                          [0, 2305.8757, 1354.9849],
-                          [0, 0, 1]], dtype=np.float32)
-
-    img = img.copy()
-    for pt in coords:
-        # Get values
-        x, y, z = pt['x'], pt['y'], pt['z']
-        yaw, pitch, roll = -pt['pitch'], -pt['yaw'], -pt['roll']
-        # Math
-        Rt = np.eye(4)
-        t = np.array([x, y, z])
-        Rt[:3, 3] = t
-        Rt[:3, :3] = euler_to_rot(yaw, pitch, roll).T
-        Rt = Rt[:3, :]
-        P = np.array([[x_l, -y_l, -z_l, 1],
-                      [x_l, -y_l, z_l, 1],
-                      [-x_l, -y_l, z_l, 1],
-                      [-x_l, -y_l, -z_l, 1],
-                      [0, 0, 0, 1]]).T
-        img_cor_pts = np.dot(camera_matrix, np.dot(Rt, P))
-        img_cor_pts = img_cor_pts.T
-        img_cor_pts[:, 0] /= img_cor_pts[:, 2]
-        img_cor_pts[:, 1] /= img_cor_pts[:, 2]
-        img_cor_pts = img_cor_pts.astype(int)
-        # plot
-        img = draw_line(img, img_cor_pts)
-        img = draw_points(img, img_cor_pts[-1:])
-
-    return img
\ No newline at end of file
+    # all cars are projected at once, see render.draw_cars
+    return draw_cars(img, coords, load_camera())
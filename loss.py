@@ -0,0 +1,64 @@
+##########################################################################
+# Loss
+##########################################################################
+import torch
+import torch.nn.functional as F
+
+# weight of the pose L1 term against the mask BCE
+GAMMA = 5.0
+
+
+def criterion(prediction, mask, regr, size_average=True, gamma=GAMMA):
+    # prediction: model output, channel 0 is the mask logit, 1: the pose maps
+    # mask: 0/1 car centers; regr: pose targets at the centers
+    # same values as criterion_reference, but the BCE is computed from the logits in one
+    # kernel (no sigmoid / log temporaries, stable for large logits) and the L1 term
+    # only at the cells with a car instead of over the full 7-channel maps
+    batch_size = prediction.shape[0]
+    # Binary mask loss, mean over the batch and sum over the grid
+    mask_loss = F.binary_cross_entropy_with_logits(prediction[:, 0], mask, reduction='sum') / batch_size
+
+    # Regression L1 loss at the positive cells, averaged per image
+    b, r, c = torch.nonzero(mask, as_tuple=True)
+    weight = mask[b, r, c]
+    l1 = (prediction[b, 1:, r, c] - regr[b, :, r, c]).abs().sum(1) * weight
+    per_image = prediction.new_zeros(batch_size).index_add_(0, b, l1)
+    # like criterion_reference, an image without cars gives nan here
+    regr_loss = (per_image / mask.sum((1, 2))).mean(0)
+
+    # Sum
+    loss = mask_loss + gamma * regr_loss
+    if not size_average:
+        loss *= batch_size
+    return mask_loss, regr_loss, loss
+
+
+def per_image_loss(prediction, mask, regr, gamma=GAMMA):
+    # criterion of every image of the batch on its own, [B]; an image without cars only has
+    # the mask term. For the hard example sampler (label_index.py), call it on detached outputs
+    batch_size = prediction.shape[0]
+    mask_loss = F.binary_cross_entropy_with_logits(prediction[:, 0], mask, reduction='none').sum((1, 2))
+    b, r, c = torch.nonzero(mask, as_tuple=True)
+    l1 = (prediction[b, 1:, r, c] - regr[b, :, r, c]).abs().sum(1) * mask[b, r, c]
+    regr_loss = prediction.new_zeros(batch_size).index_add_(0, b, l1) / mask.sum((1, 2)).clamp(min=1)
+    return mask_loss + gamma * regr_loss
+
+
+def criterion_reference(prediction, mask, regr, size_average=True, gamma=GAMMA):
+    # the original dense version of criterion, kept for benchmark.criterion_report
+    # Binary mask loss
+    pred_mask = torch.sigmoid(prediction[:, 0])
+    mask_loss = mask * torch.log(pred_mask + 1e-12) + \
+        (1 - mask) * torch.log(1 - pred_mask + 1e-12)
+    mask_loss = -mask_loss.mean(0).sum()
+
+    # Regression L1 loss, only where there is a car
+    pred_regr = prediction[:, 1:]
+    regr_loss = (torch.abs(pred_regr - regr).sum(1) * mask).sum(1).sum(1) / mask.sum(1).sum(1)
+    regr_loss = regr_loss.mean(0)
+
+    # Sum
+    loss = mask_loss + gamma * regr_loss
+    if not size_average:
+        loss *= prediction.shape[0]
+    return mask_loss, regr_loss, loss
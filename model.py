@@ -2,14 +2,9 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.optim as optim
-import cv2
 
-from efficientnet_pytorch import EfficientNet
+from backbones import build_backbone, feature_channels
 
-IMG_WIDTH = 1024
-IMG_HEIGHT = IMG_WIDTH // 16 * 5
-MODEL_SCALE = 8
 # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 effnet_ver = 'b0'
@@ -18,19 +13,24 @@ dropout_rate = 0.3
 
 # dropout_rate = 0.0
 
-# def set_dropout(model, drop_rate):
-#     # source: https://discuss.pytorch.org/t/how-to-increase-dropout-rate-during-training/58107/4
-#     for name, child in model.named_children():
-#         if isinstance(child, torch.nn.Dropout):
-#             child.p = drop_rate
-#             print("name:", name)
-#             print("children:\n", child)
+def set_dropout(model, drop_rate):
+    # source: https://discuss.pytorch.org/t/how-to-increase-dropout-rate-during-training/58107/4
+    for name, child in model.named_children():
+        if isinstance(child, torch.nn.Dropout):
+            child.p = drop_rate
+            print("name:", name)
+            print("children:\n", child)
 
 
-# def effnet_dropout(drop_rate):
-#     base_model0 = EfficientNet.from_pretrained(f"efficientnet-{effnet_ver}")
-#     set_dropout(base_model0, drop_rate)
-#     return base_model0
+def effnet_dropout(drop_rate):
+    base_model0 = build_backbone(f"efficientnet-{effnet_ver}")
+    set_dropout(base_model0, drop_rate)
+    return base_model0
+
+
+def scale_channels(ch, mult):
+    # channel count times a width multiplier, kept a multiple of 8 for the //8 splits of res_block
+    return max(8, int(round(ch * mult / 8)) * 8)
 
 
 class double_conv(nn.Module):
@@ -148,15 +148,17 @@ class up(nn.Module):
     '''(Respath+ConvT)=>ResBlock '''
     '''in_ch1(ConvT),in_ch2(Respath)=>out_ch,dim_out==2*dim_in '''
 
-    def __init__(self, in_ch1, in_ch2, out_ch):
+    def __init__(self, in_ch1, in_ch2, out_ch, path_ch=None):
         super(up, self).__init__()
+        # path_ch: width of the res_path skip, 2 * in_ch2 by default
+        path_ch = path_ch or 2 * in_ch2
         self.up = nn.ConvTranspose2d(in_ch1, in_ch1, 2, stride=2, padding=1, output_padding=1)
         self.bn = nn.BatchNorm2d(in_ch1)
         self.relu = nn.ReLU()
 
-        self.respath = res_path(in_ch2, 2 * in_ch2)
+        self.respath = res_path(in_ch2, path_ch)
 
-        self.conv = double_conv(in_ch1 + 2 * in_ch2, out_ch)
+        self.conv = double_conv(in_ch1 + path_ch, out_ch)
 
     #         self.conv = res_block(in_ch1+2*in_ch2, out_ch)
 
@@ -180,6 +182,10 @@ class up(nn.Module):
         return x
 
 
+# name used by the ConvMultiRes notebook code
+up_sampling = up
+
+
 class output_conv(nn.Module):
     '''(conv => BN => ReLU => 1*1conv) '''
     '''in_ch=>out_ch,dim_out==dim_in '''
@@ -197,14 +203,33 @@ class output_conv(nn.Module):
         x = self.conv(x)
         return x
 
+    def forward_at(self, x, b, r, c):
+        # the head evaluated only at cells (b[i], r[i], c[i]) of x: [B, in_ch, H, W] -> [N, out_ch]
+        # each cell only sees its 3x3 neighbourhood, so gather those patches
+        # and run the 3x3 conv without padding on them
+        conv = self.conv[0]
+        xp = F.pad(x, (1, 1, 1, 1))
+        d = torch.arange(3, device=x.device)
+        rows = r[:, None, None] + d[None, :, None]
+        cols = c[:, None, None] + d[None, None, :]
+        # advanced indices around a slice put the channels last: [N, 3, 3, in_ch]
+        patches = xp[b[:, None, None], :, rows, cols].permute(0, 3, 1, 2)
+        y = F.conv2d(patches, conv.weight, conv.bias)
+        if getattr(conv, 'fused_relu', False):
+            # optimize.ConvReLU took over the ReLU
+            y = F.relu(y)
+        return self.conv[1:](y)[:, :, 0, 0]
+
 
 class MyUNet(nn.Module):
     '''Mixture of previous classes'''
 
-    def __init__(self, n_classes):
+    def __init__(self, n_classes, backbone=None, pretrained=True):
         super(MyUNet, self).__init__()
         self.drop_rate = dropout_rate
-        self.base_model = EfficientNet.from_pretrained(f"efficientnet-{effnet_ver}")
+        # any name of backbones.BACKBONES, weights from the local cache
+        self.backbone = backbone or f"efficientnet-{effnet_ver}"
+        self.base_model = build_backbone(self.backbone, pretrained)
         #         self.base_model = effnet_dropout(drop_rate = self.drop_rate)
         self.conv0 = double_conv(3, 64)
         self.conv1 = double_conv(64, 128)
@@ -216,18 +241,7 @@ class MyUNet(nn.Module):
         #         self.conv3 = res_block(512, 1024)
         self.mp = nn.MaxPool2d(2)
 
-        if effnet_ver == 'b0':
-            self.up1 = up(1280, 1024, 512)
-        elif effnet_ver == 'b1':
-            self.up1 = up(1280, 1024, 512)
-        elif effnet_ver == 'b2':
-            self.up1 = up(1408, 1024, 512)
-        elif effnet_ver == 'b3':
-            self.up1 = up(1536, 1024, 512)
-        elif effnet_ver == 'b4':
-            self.up1 = up(1792, 1024, 512)
-        elif effnet_ver == 'b5':
-            self.up1 = up(2048, 1024, 512)
+        self.up1 = up(feature_channels(self.base_model), 1024, 512)
         #         self.up1 = up(1536,1024, 512)
         self.up2 = up(512, 512, 256)
         #         self.outc = nn.Conv2d(256, n_classes, 1)
@@ -276,4 +290,93 @@ class MyUNet(nn.Module):
         return xout
 
 
+class ConvMultiRes(nn.Module):
+    '''Conv Encoder + MultiRes Decoder'''
+    '''widths: channel multipliers of the (double_conv encoder, res_path skips, up_sampling decoder)'''
+
+    def __init__(self, n_classes, backbone=None, pretrained=True, widths=(1, 1, 1)):
+        super(ConvMultiRes, self).__init__()
+        self.drop_rate = dropout_rate
+        # any name of backbones.BACKBONES, weights from the local cache
+        self.backbone = backbone or f"efficientnet-{effnet_ver}"
+        self.widths = tuple(widths)
+        enc, path, dec = [lambda ch, m=m: scale_channels(ch, m) for m in self.widths]
+        self.base_model = build_backbone(self.backbone, pretrained)
+        #         self.base_model = effnet_dropout(drop_rate = self.drop_rate)
+        self.conv0 = double_conv(3, enc(64))
+        self.conv1 = double_conv(enc(64), enc(128))
+        self.conv2 = double_conv(enc(128), enc(512))
+        self.conv3 = double_conv(enc(512), enc(1024))
+        self.mp = nn.MaxPool2d(2)
+
+        self.up1 = up_sampling(feature_channels(self.base_model), enc(1024), dec(512), path(2048))
+        self.up2 = up_sampling(dec(512), enc(512), dec(256), path(1024))
+        self.poseconv = output_conv(dec(256), dec(1024), 7)
+        self.detectionconv = output_conv(dec(256), dec(256), 1)
+
+    def features(self, x):
+        # torch.Size([1, 3, 320, 1024])
+        x1 = self.mp(self.conv0(x))
+        # torch.Size([1, 64, 160, 512])
+        x2 = self.mp(self.conv1(x1))
+        # torch.Size([1, 128, 80, 256])
+        x3 = self.mp(self.conv2(x2))
+        # torch.Size([1, 512, 40, 128])
+        x4 = self.mp(self.conv3(x3))
+        # torch.Size([1, 1024, 20, 64])
+
+        feats = self.base_model.extract_features(x)
+
+        x = self.up1(feats, x4)
+        # torch.Size([1, 512, 20, 64])
+        x = self.up2(x, x3)
+        # torch.Size([1, 256, 40, 128])
+        return x
+
+    def forward(self, x):
+        x = self.features(x)
+        xout_1 = self.detectionconv(x)
+        xout_2 = self.poseconv(x)
+        xout = torch.cat([xout_1, xout_2], dim=1)
+        # torch.Size([1, 8, 40, 128])
+        return xout
 
+    def forward_sparse(self, x, threshold=0, top_k=100):
+        # inference only: the detection head runs on the full grid, the pose head
+        # (3x3 conv to 1024 channels) only at the heatmap peaks
+        # returns the usual [B, 8, H, W] output, pose channels are zero away from the peaks,
+        # and the peak (row, col) arrays per image for decode_batch
+        if self.training:
+            raise RuntimeError('forward_sparse needs eval mode (BatchNorm running stats)')
+        # decode pulls in the label helpers (cv2), only needed here
+        from decode import extract_peaks
+        x = self.features(x)
+        xout_1 = self.detectionconv(x)
+        points, _ = extract_peaks(xout_1, threshold, top_k)
+        b = torch.cat([torch.full((len(p),), i, dtype=torch.long) for i, p in enumerate(points)])
+        rc = torch.from_numpy(np.concatenate(points)).long().reshape([-1, 2])
+        b, r, c = b.to(x.device), rc[:, 0].to(x.device), rc[:, 1].to(x.device)
+        xout_2 = x.new_zeros((x.shape[0], 7) + x.shape[2:])
+        if len(b):
+            xout_2[b, :, r, c] = self.poseconv.forward_at(x, b, r, c)
+        return torch.cat([xout_1, xout_2], dim=1), points
+
+
+def load_model(path, device='cpu', n_classes=8, backbone=None, widths=(1, 1, 1), ema=True):
+    # read a checkpoint for inference: a whole pickled model (torch.save(model)),
+    # a ConvMultiRes state_dict (backbone weights come from the checkpoint)
+    # or an ema.checkpoint dict, whose EMA weights are used unless ema=False
+    obj = torch.load(path, map_location=device, weights_only=False)
+    if isinstance(obj, nn.Module):
+        return obj.to(device).eval()
+    state = obj
+    if 'model' in obj:
+        backbone = obj.get('backbone') or backbone
+        widths = obj.get('widths') or widths
+        state = obj['ema']['module'] if ema and 'ema' in obj else obj['model']
+    if obj.get('arch') == 'MyUNet':
+        model = MyUNet(n_classes, backbone, pretrained=False)
+    else:
+        model = ConvMultiRes(n_classes, backbone, pretrained=False, widths=widths)
+    model.load_state_dict(state)
+    return model.to(device).eval()
@@ -0,0 +1,227 @@
+##########################################################################
+# CPU inference optimizations
+#
+#   python optimize.py --model model_test_org.pth --batch-sizes 1 2 4 8
+#
+# optimize_for_inference folds every BatchNorm that directly follows a conv
+# into the conv weights, replaces conv + ReLU pairs by one fused oneDNN
+# kernel and switches the model to channels_last, so the many torch.cat
+# of res_block / respath_block / up_sampling stay in one memory layout.
+# The CLI measures throughput for every (intra-op, inter-op threads,
+# batch size) on this host and saves the best configuration, which the
+# server and the streaming tool pick up with --optimize.
+##########################################################################
+import json
+import os
+import socket
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_conv_bn_weights
+
+INFERENCE_CONFIG = './inference_config.json'
+IMG_SHAPE = (3, 320, 1024)
+# (conv, BN) attribute pairs of the EfficientNet stem / head and MBConv blocks
+EFFNET_CONV_BN = [('_conv_stem', '_bn0'), ('_conv_head', '_bn1'),
+                  ('_expand_conv', '_bn0'), ('_depthwise_conv', '_bn1'), ('_project_conv', '_bn2')]
+
+try:
+    _CONV_POINTWISE = torch.ops.mkldnn._convolution_pointwise
+except (AttributeError, RuntimeError):
+    _CONV_POINTWISE = None
+
+
+class ConvReLU(nn.Module):
+    '''Conv2d followed by ReLU'''
+    '''one oneDNN kernel on CPU in inference, conv then relu otherwise'''
+
+    fused_relu = True
+
+    def __init__(self, conv):
+        super(ConvReLU, self).__init__()
+        self.conv = conv
+
+    @property
+    def weight(self):
+        return self.conv.weight
+
+    @property
+    def bias(self):
+        return self.conv.bias
+
+    def forward(self, x):
+        c = self.conv
+        if _CONV_POINTWISE is not None and x.device.type == 'cpu' and x.dtype == torch.float32 \
+                and not torch.is_grad_enabled():
+            return _CONV_POINTWISE(x, c.weight, c.bias, c.padding, c.stride, c.dilation, c.groups,
+                                   'relu', [], '')
+        return F.relu(c(x))
+
+
+def fold_bn(model):
+    # conv -> BN inside nn.Sequential (double_conv, res_block, respath_block, output_conv,
+    # torchvision encoders), the EfficientNet conv / BN attributes and ConvTranspose -> BN
+    # of up_sampling; the BN becomes an Identity so Sequential indices do not move
+    for module in model.modules():
+        for conv_name, bn_name in EFFNET_CONV_BN:
+            conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+        if isinstance(module, nn.Sequential):
+            layers = list(module)
+            for i in range(len(layers) - 1):
+                if isinstance(layers[i], nn.Conv2d) and isinstance(layers[i + 1], nn.BatchNorm2d):
+                    module[i] = fuse_conv_bn_eval(layers[i], layers[i + 1])
+                    module[i + 1] = nn.Identity()
+        up = getattr(module, 'up', None)
+        if isinstance(up, nn.ConvTranspose2d) and isinstance(getattr(module, 'bn', None), nn.BatchNorm2d):
+            bn = module.bn
+            up.weight, up.bias = fuse_conv_bn_weights(up.weight, up.bias, bn.running_mean, bn.running_var,
+                                                      bn.eps, bn.weight, bn.bias, transpose=True)
+            module.bn = nn.Identity()
+    return model
+
+
+def fuse_conv_relu(model):
+    # [Conv2d, (Identity,) ReLU] inside nn.Sequential -> [ConvReLU, (Identity,) Identity]
+    # only plain nn.Conv2d, subclasses such as the EfficientNet same-padding convs have their own forward
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        layers = list(module)
+        for i, layer in enumerate(layers):
+            if type(layer) is not nn.Conv2d:
+                continue
+            j = i + 1
+            while j < len(layers) and isinstance(layers[j], nn.Identity):
+                j += 1
+            if j < len(layers) and type(layers[j]) is nn.ReLU:
+                module[i] = ConvReLU(layer)
+                module[j] = nn.Identity()
+    return model
+
+
+def _to_channels_last(module, args):
+    x = args[0]
+    if x.dim() == 4:
+        return (x.contiguous(memory_format=torch.channels_last),) + tuple(args[1:])
+
+
+def optimize_for_inference(model, channels_last=True):
+    # eval-only model with folded BN and fused conv + ReLU, modified in place
+    model.eval()
+    with torch.no_grad():
+        fold_bn(model)
+        fuse_conv_relu(model)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+        # one hook however often the model is optimized (server, autotune, a reloaded model)
+        if getattr(model, '_channels_last_hook', None) is None:
+            model._channels_last_hook = model.register_forward_pre_hook(_to_channels_last)
+    return model
+
+
+##########################################################################
+# Thread autotuning
+##########################################################################
+def host_key():
+    return '{}-{}cpu'.format(socket.gethostname(), os.cpu_count())
+
+
+def _measure(job):
+    # runs in a fresh process: inter-op threads can only be set before any parallel work
+    model_path, num_threads, interop_threads, batch_sizes, img_shape, optimize, repeats = job
+    from model import load_model
+    from benchmark import measure_latency
+    torch.set_num_interop_threads(interop_threads)
+    torch.set_num_threads(num_threads)
+    model = load_model(model_path)
+    if optimize:
+        optimize_for_inference(model)
+    rows = []
+    for batch_size in batch_sizes:
+        ms = measure_latency(model, torch.zeros((batch_size,) + tuple(img_shape)), repeats=repeats)['median_ms']
+        rows.append({'num_threads': num_threads, 'interop_threads': interop_threads, 'batch_size': batch_size,
+                     'ms_per_batch': ms, 'images_per_s': batch_size / ms * 1000})
+    return rows
+
+
+def autotune_threads(model_path, batch_sizes=(1, 2, 4, 8), thread_options=None, interop_options=(1, 2),
+                     img_shape=IMG_SHAPE, optimize=True, repeats=5, path=INFERENCE_CONFIG):
+    # images/s for every thread configuration and batch size; the best one is saved for this host
+    import multiprocessing
+    if thread_options is None:
+        cpus = os.cpu_count()
+        thread_options = sorted({2 ** i for i in range(cpus.bit_length()) if 2 ** i <= cpus} | {cpus})
+    ctx = multiprocessing.get_context('spawn')
+    rows = []
+    for num_threads in thread_options:
+        for interop_threads in interop_options:
+            with ctx.Pool(1) as pool:
+                rows += pool.apply(_measure, ((model_path, num_threads, interop_threads, list(batch_sizes),
+                                               img_shape, optimize, repeats),))
+            print(rows[-len(batch_sizes):])
+    best = max(rows, key=lambda r: r['images_per_s'])
+    per_batch = {str(b): max((r for r in rows if r['batch_size'] == b), key=lambda r: r['images_per_s'])
+                 for b in batch_sizes}
+    config = dict(best, optimize=optimize, per_batch_size=per_batch, results=rows)
+    save_inference_config(config, path)
+    return config
+
+
+def save_inference_config(config, path=INFERENCE_CONFIG):
+    # one entry per host, other hosts' entries are kept
+    configs = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            configs = json.load(f)
+    configs[host_key()] = config
+    with open(path, 'w') as f:
+        json.dump(configs, f, indent=1)
+
+
+def load_inference_config(path=INFERENCE_CONFIG, batch_size=None):
+    # saved configuration of this host (for batch_size if given) or None
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        config = json.load(f).get(host_key())
+    if config is not None and batch_size is not None:
+        return config['per_batch_size'].get(str(batch_size), config)
+    return config
+
+
+def apply_inference_config(path=INFERENCE_CONFIG, batch_size=None):
+    # set the tuned thread counts, returns the configuration used (None when not tuned on this host)
+    config = load_inference_config(path, batch_size)
+    if config is None:
+        return None
+    torch.set_num_threads(config['num_threads'])
+    try:
+        torch.set_num_interop_threads(config['interop_threads'])
+    except RuntimeError:
+        # too late once parallel work ran in this process
+        pass
+    return config
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Autotune CPU threads for inference and save the best setting')
+    parser.add_argument('--model', default='./model_test_org.pth')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--threads', type=int, nargs='+', default=None, help='intra-op thread counts to try')
+    parser.add_argument('--interop', type=int, nargs='+', default=[1, 2], help='inter-op thread counts to try')
+    parser.add_argument('--height', type=int, default=IMG_SHAPE[1])
+    parser.add_argument('--width', type=int, default=IMG_SHAPE[2])
+    parser.add_argument('--no-optimize', action='store_true', help='tune the plain model')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--config', default=INFERENCE_CONFIG)
+    args = parser.parse_args()
+
+    config = autotune_threads(args.model, args.batch_sizes, args.threads, args.interop,
+                              (3, args.height, args.width), not args.no_optimize, args.repeats, args.config)
+    print('best: {num_threads} threads, {interop_threads} inter-op, batch {batch_size}: '
+          '{images_per_s:.2f} images/s'.format(**config))
+    print('saved to', args.config)
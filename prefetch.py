@@ -0,0 +1,85 @@
+##########################################################################
+# Device prefetching for the training / evaluation loops
+##########################################################################
+import time
+import torch
+
+
+class DevicePrefetcher:
+    '''Iterates a DataLoader with every batch already on device'''
+    '''on cuda batch i+1 is copied on a side stream while the model works on batch i'''
+
+    def __init__(self, loader, device='cpu'):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        # two slots of pinned host / device buffers, reused while the batch shapes stay the same
+        # (a yielded batch is overwritten two steps later, copy it to keep it)
+        self._host = [None, None]
+        self._dev = [None, None]
+        self._copied = [None, None]
+        self.data_wait = 0.0
+        self.total = 0.0
+        self.steps = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    @staticmethod
+    def _buffers(cache, slot, batch, **kwargs):
+        buffers = cache[slot]
+        if buffers is None or [(b.shape, b.dtype) for b in buffers] != [(t.shape, t.dtype) for t in batch]:
+            buffers = [torch.empty(t.shape, dtype=t.dtype, **kwargs) for t in batch]
+            cache[slot] = buffers
+        return buffers
+
+    def _stage(self, batch, slot):
+        # host batch -> device buffers of slot; asynchronous on cuda, nothing to copy on cpu
+        batch = [torch.as_tensor(t) for t in batch]
+        if not self.cuda:
+            return batch
+        if self._copied[slot] is not None:
+            # the previous copy out of this slot's host buffers must be done before refilling them
+            self._copied[slot].synchronize()
+        if not all(t.is_pinned() for t in batch):
+            host = self._buffers(self._host, slot, batch, pin_memory=True)
+            for h, t in zip(host, batch):
+                h.copy_(t)
+            batch = host
+        dev = self._buffers(self._dev, slot, batch, device=self.device)
+        # and the compute that read this slot two steps ago must be done before overwriting it
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            for d, h in zip(dev, batch):
+                d.copy_(h, non_blocking=True)
+            self._copied[slot] = torch.cuda.Event()
+            self._copied[slot].record(self.stream)
+        return dev
+
+    def __iter__(self):
+        start = time.perf_counter()
+        wait = time.perf_counter()
+        it = iter(self.loader)
+        batch = next(it, None)
+        ready = None if batch is None else self._stage(batch, 0)
+        step = 0
+        while ready is not None:
+            # queue the copy of the next batch before handing out this one
+            batch = next(it, None)
+            upcoming = None if batch is None else self._stage(batch, (step + 1) % 2)
+            if self.cuda:
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            self.data_wait += time.perf_counter() - wait
+            self.steps += 1
+            yield ready
+            wait = time.perf_counter()
+            ready = upcoming
+            step += 1
+        self.total += time.perf_counter() - start
+
+    def stats(self):
+        # time spent waiting for data vs total time of the passes so far
+        return {'steps': self.steps, 'data_wait_s': self.data_wait, 'total_s': self.total,
+                'wait_fraction': self.data_wait / self.total if self.total else 0.0,
+                'mean_wait_ms': self.data_wait / max(1, self.steps) * 1000}
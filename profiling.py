@@ -0,0 +1,210 @@
+##########################################################################
+# Opt-in torch.profiler runs of the train / dev / prediction loops
+#
+#   profiler = StepProfiler('train', enabled=True, model=model)
+#   train_epoch(model, loader, optimizer, profiler=profiler)
+#
+#   python profiling.py --mode train --batch 2      # synthetic batches
+#
+# A window of steps (wait, warmup, active) is recorded with the phases
+# loader-wait, forward, loss, backward, optimizer and decode labelled, and
+# with forward hooks labelling up_sampling, res_path, the conv encoder and
+# the backbone stages. Each recorded window is written to out_dir as a Chrome trace
+# (chrome://tracing or ui.perfetto.dev) and a top-N operator table.
+##########################################################################
+import contextlib
+import os
+import time
+import torch
+
+PROFILE_DIR = './profiles/'
+PHASES = ('loader-wait', 'forward', 'loss', 'backward', 'optimizer', 'decode')
+# module labels in the trace start with this prefix
+MODULE_PREFIX = 'module::'
+
+
+def _stages(model):
+    # (label, first module, last module) of the parts of a model worth a trace label
+    from model import up, res_path, double_conv
+    from backbones import TorchvisionEncoder
+    from distributed import unwrap_model
+    stages = []
+    # names without the module. prefix of DistributedDataParallel, the encoder is found by its top-level name
+    for name, module in unwrap_model(model).named_modules():
+        if isinstance(module, (up, res_path)) or isinstance(module, double_conv) and '.' not in name:
+            # decoder blocks and the conv0..conv3 encoder
+            stages.append((name, module, module))
+        elif isinstance(module, TorchvisionEncoder):
+            for i, child in enumerate(module.features):
+                stages.append(('{}.stage{}'.format(name, i), child, child))
+        elif hasattr(module, '_blocks') and hasattr(module, '_conv_stem'):
+            # EfficientNet: the blocks are called one by one in extract_features,
+            # a stage is a run of blocks with the same output filters
+            stages.append((name + '.stem', module._conv_stem, module._conv_stem))
+            blocks = list(module._blocks)
+            start = 0
+            for i in range(1, len(blocks) + 1):
+                if i == len(blocks) or blocks[i]._block_args.output_filters != \
+                        blocks[start]._block_args.output_filters:
+                    stage = sum(label.startswith(name + '.stage') for label, _, _ in stages) + 1
+                    stages.append(('{}.stage{}'.format(name, stage), blocks[start], blocks[i - 1]))
+                    start = i
+            stages.append((name + '.head', module._conv_head, module._conv_head))
+    return stages
+
+
+def label_modules(model):
+    # record_function labels around up_sampling, res_path and backbone stage forwards,
+    # returns the hook handles (call .remove() on each to undo)
+    handles = []
+    for label, first, last in _stages(model):
+        records = []
+
+        def enter(module, args, label=label, records=records):
+            record = torch.profiler.record_function(MODULE_PREFIX + label)
+            record.__enter__()
+            records.append(record)
+
+        def leave(module, args, output, records=records):
+            if records:
+                records.pop().__exit__(None, None, None)
+
+        handles.append(first.register_forward_pre_hook(enter))
+        handles.append(last.register_forward_hook(leave))
+    return handles
+
+
+class StepProfiler:
+    '''torch.profiler over a window of loop steps with labelled phases'''
+    '''disabled it does nothing, so the loops can always take one'''
+
+    def __init__(self, name='train', enabled=False, model=None, wait=5, warmup=2, active=5, repeat=1,
+                 out_dir=PROFILE_DIR, top=20):
+        self.name = name
+        self.enabled = enabled
+        self.model = model
+        self.out_dir = out_dir
+        self.top = top
+        self.schedule = dict(wait=wait, warmup=warmup, active=active, repeat=repeat)
+        self._profiler = None
+        self._handles = []
+        self.traces = []
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        os.makedirs(self.out_dir, exist_ok=True)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(activities=activities,
+                                                schedule=torch.profiler.schedule(**self.schedule),
+                                                on_trace_ready=self._export, record_shapes=True)
+        if self.model is not None:
+            self._handles = label_modules(self.model)
+        self._profiler.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        if self._profiler is not None:
+            self._profiler.__exit__(*exc)
+            self._profiler = None
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def phase(self, name):
+        # context manager labelling one phase of the current step
+        if self._profiler is None:
+            return contextlib.nullcontext()
+        return torch.profiler.record_function(name)
+
+    def iterate(self, iterable):
+        # yields the items of iterable with the time spent getting each one labelled loader-wait
+        it = iter(iterable)
+        while True:
+            with self.phase('loader-wait'):
+                item = next(it, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def step(self):
+        # end of one loop step
+        if self._profiler is not None:
+            self._profiler.step()
+
+    def _export(self, prof):
+        # Chrome trace and top-N operator table of one recorded window
+        stem = os.path.join(self.out_dir, '{}_{}_{}'.format(self.name, time.strftime('%Y%m%d-%H%M%S'),
+                                                           prof.step_num))
+        prof.export_chrome_trace(stem + '.json')
+        sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        averages = prof.key_averages()
+        labels = [e for e in averages if e.key in PHASES or e.key.startswith(MODULE_PREFIX)]
+        with open(stem + '.txt', 'w') as f:
+            f.write('phases and modules\n')
+            f.write(_label_table(labels))
+            f.write('\ntop {} operators by {}\n'.format(self.top, sort_by))
+            f.write(averages.table(sort_by=sort_by, row_limit=self.top))
+        self.traces.append(stem + '.json')
+        print('Profile of {} written to {}.json / .txt'.format(self.name, stem))
+        print(_label_table(labels))
+
+
+def _label_table(events):
+    # total time per phase / module label, slowest first
+    rows = sorted(events, key=lambda e: -e.cpu_time_total)
+    lines = ['{:<40s}{:>8s}{:>14s}{:>14s}'.format('label', 'calls', 'cpu total ms', 'cpu mean ms')]
+    for e in rows:
+        lines.append('{:<40s}{:>8d}{:>14.2f}{:>14.2f}'.format(e.key, e.count, e.cpu_time_total / 1e3,
+                                                             e.cpu_time_total / 1e3 / max(1, e.count)))
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == "__main__":
+    import argparse
+    from torch.utils.data import TensorDataset, DataLoader
+    from model import ConvMultiRes, load_model
+    from engine import train_epoch, evaluate
+    parser = argparse.ArgumentParser(description='Profile training / inference steps on synthetic batches')
+    parser.add_argument('--model', default=None, help='checkpoint, a random ConvMultiRes by default')
+    parser.add_argument('--mode', choices=['train', 'dev', 'predict'], default='train')
+    parser.add_argument('--batch', type=int, default=2)
+    parser.add_argument('--height', type=int, default=320)
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--wait', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--active', type=int, default=3)
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--out-dir', default=PROFILE_DIR)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = load_model(args.model, device) if args.model else ConvMultiRes(8, pretrained=False).to(device)
+    n = (args.wait + args.warmup + args.active) * args.batch
+    grid = (args.height // 8, args.width // 8)
+    mask = torch.zeros((n,) + grid)
+    mask[:, grid[0] // 2, ::16] = 1
+    dataset = TensorDataset(torch.rand(n, 3, args.height, args.width), mask, torch.rand((n, 7) + grid))
+    loader = DataLoader(dataset, batch_size=args.batch)
+    profiler = StepProfiler(args.mode, True, model, args.wait, args.warmup, args.active,
+                            out_dir=args.out_dir, top=args.top)
+    if args.mode == 'train':
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+        train_epoch(model, loader, optimizer, device=device, profiler=profiler)
+    elif args.mode == 'dev':
+        evaluate(model, loader, device, profiler=profiler)
+    else:
+        from decode import predict, decode_batch
+        from ground_plane import GroundPlane, GROUND_PLANE_FILE
+        # the decode cost does not depend much on the plane, a flat one when none was fitted
+        plane = GroundPlane.load() if os.path.exists(GROUND_PLANE_FILE) else GroundPlane((0, 0), 0)
+        model.eval()
+        with profiler:
+            for img, _, _ in profiler.iterate(loader):
+                with profiler.phase('forward'):
+                    output = predict(model, img.to(device))
+                with profiler.phase('decode'):
+                    decode_batch(output, plane, threshold=0)
+                profiler.step()
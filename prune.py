@@ -0,0 +1,231 @@
+##########################################################################
+# Structured channel pruning of ConvMultiRes
+#
+#   python prune.py --model model_test_org.pth --ratio 0.5 --epochs 1
+#
+# Channels of the plain-conv encoder (double_conv) and of the res_path skips
+# are ranked by BN scale or filter L1 norm and removed physically: every
+# Conv2d / BatchNorm2d that reads or writes a pruned channel is rebuilt
+# smaller, including the torch.cat offsets of respath_block, res_block and
+# up_sampling. The pruned model is fine-tuned briefly and saved whole.
+##########################################################################
+import collections
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+
+# prunable parts of ConvMultiRes, the biggest ones by default
+TARGETS = ('conv0', 'conv1', 'conv2', 'conv3', 'up1.respath', 'up2.respath')
+DEFAULT_TARGETS = ('conv3', 'up1.respath')
+
+# a prunable channel group: the conv that writes the channels, the BNs normalizing them and
+# the convs reading them, each with the offset of the group inside that layer's channels
+Group = collections.namedtuple('Group', ['name', 'producer', 'bns', 'consumers', 'rank_bn'])
+
+
+def _modules(model):
+    return dict(model.named_modules())
+
+
+def _double_conv_groups(name, consumers):
+    # inner channels (conv.0 -> conv.3) and output channels of a double_conv
+    return [Group(name + '.inner', name + '.conv.0', [(name + '.conv.1', 0)], [(name + '.conv.3', 0)],
+                  (name + '.conv.1', 0)),
+            Group(name + '.out', name + '.conv.3', [(name + '.conv.4', 0)], consumers, (name + '.conv.4', 0))]
+
+
+def _shift(layers, offset):
+    return [(layer, o + offset) for layer, o in layers]
+
+
+def _block_inputs(modules, name):
+    # convs reading the input of a respath_block / res_block
+    if hasattr(modules[name], 'sc'):
+        return [(name + '.sc', 0), (name + '.conv1.0', 0)]
+    return [(name + '.conv1.0', 0), (name + '.conv2.0', 0)]
+
+
+def _res_path_groups(modules, name, consumers):
+    # res_path = respath_block, respath_block, res_block, res_block; the output of
+    # each block is a concat whose segments are pruned separately
+    blocks = [name + '.rp{}'.format(i) for i in range(1, 5)]
+    groups = []
+    for i, block in enumerate(blocks):
+        after = _block_inputs(modules, blocks[i + 1]) if i + 1 < len(blocks) else consumers
+        module = modules[block]
+        if hasattr(module, 'sc'):
+            # res_block: cat([sc, bn(cat([p1, p2, p3]))]) -> addconv
+            half = module.sc.out_channels
+            groups.append(Group(block + '.sc', block + '.sc', [(block + '.addconv.1', 0)], after,
+                                (block + '.addconv.1', 0)))
+            offset = 0
+            for j, nxt in [(1, block + '.conv2.0'), (2, block + '.conv3.0'), (3, None)]:
+                conv = block + '.conv{}'.format(j)
+                inside = [(nxt, 0)] if nxt else []
+                groups.append(Group(conv, conv + '.0',
+                                    [(conv + '.1', 0), (block + '.bn', offset), (block + '.addconv.1', half + offset)],
+                                    inside + _shift(after, half + offset), (conv + '.1', 0)))
+                offset += modules[conv + '.0'].out_channels
+        else:
+            # respath_block: cat([conv1, conv2]) -> addconv
+            half = module.conv1[0].out_channels
+            for j, offset in [(1, 0), (2, half)]:
+                conv = block + '.conv{}'.format(j)
+                groups.append(Group(conv, conv + '.0', [(conv + '.1', 0), (block + '.addconv.1', offset)],
+                                    _shift(after, offset), (conv + '.1', 0)))
+    return groups
+
+
+def channel_groups(model, targets=DEFAULT_TARGETS):
+    modules = _modules(model)
+    encoder_consumers = {
+        'conv0': [('conv1.conv.0', 0)],
+        'conv1': [('conv2.conv.0', 0)],
+        'conv2': [('conv3.conv.0', 0)] + _block_inputs(modules, 'up2.respath.rp1'),
+        'conv3': _block_inputs(modules, 'up1.respath.rp1'),
+    }
+    groups = []
+    for target in targets:
+        if target in encoder_consumers:
+            groups += _double_conv_groups(target, encoder_consumers[target])
+        elif target in ('up1.respath', 'up2.respath'):
+            # the res_path output is the first part of the up_sampling double_conv input
+            groups += _res_path_groups(modules, target, [(target[:3] + '.conv.conv.0', 0)])
+        else:
+            raise ValueError('Unknown prune target {}, choose from {}'.format(target, TARGETS))
+    return groups
+
+
+def channel_scores(model, group, method='bn'):
+    # importance of each channel of the group: |gamma| of its BN or the L1 norm of its filters
+    modules = _modules(model)
+    n = modules[group.producer].out_channels
+    if method == 'bn':
+        bn, offset = group.rank_bn
+        return modules[bn].weight.detach().abs()[offset:offset + n].cpu().numpy()
+    if method == 'l1':
+        return modules[group.producer].weight.detach().abs().sum((1, 2, 3)).cpu().numpy()
+    raise ValueError('method must be bn or l1')
+
+
+def _keep_count(n, ratio, multiple=8):
+    # channels left after pruning ratio of n, rounded up to a multiple of 8
+    return min(n, max(multiple, int(math.ceil(n * (1 - ratio) / multiple)) * multiple))
+
+
+def _new_conv(conv, out_keep, in_keep):
+    new = nn.Conv2d(int(in_keep.sum()), int(out_keep.sum()), conv.kernel_size, stride=conv.stride,
+                    padding=conv.padding, dilation=conv.dilation, bias=conv.bias is not None)
+    new.weight.data.copy_(conv.weight.data[out_keep][:, in_keep])
+    if conv.bias is not None:
+        new.bias.data.copy_(conv.bias.data[out_keep])
+    return new.to(conv.weight.device).train(conv.training)
+
+
+def _new_bn(bn, keep):
+    new = nn.BatchNorm2d(int(keep.sum()), eps=bn.eps, momentum=bn.momentum)
+    for name in ['weight', 'bias', 'running_mean', 'running_var']:
+        getattr(new, name).data.copy_(getattr(bn, name).data[keep])
+    new.num_batches_tracked.data.copy_(bn.num_batches_tracked.data)
+    return new.to(bn.weight.device).train(bn.training)
+
+
+def _set_module(model, name, module):
+    parent, _, child = name.rpartition('.')
+    model.get_submodule(parent)._modules[child] = module
+
+
+def prune(model, ratio=0.5, method='bn', targets=DEFAULT_TARGETS):
+    # remove ratio of the channels of every group in place, returns the model
+    # keep masks per (layer, dim) are collected first so concat offsets stay the original ones
+    modules = _modules(model)
+    out_keep, in_keep = {}, {}
+
+    def mask(masks, name, size):
+        if name not in masks:
+            masks[name] = np.ones(size, dtype=bool)
+        return masks[name]
+
+    for group in channel_groups(model, targets):
+        scores = channel_scores(model, group, method)
+        n = len(scores)
+        drop = np.argsort(-scores, kind='stable')[_keep_count(n, ratio):]
+        mask(out_keep, group.producer, n)[drop] = False
+        for bn, offset in group.bns:
+            mask(out_keep, bn, modules[bn].num_features)[drop + offset] = False
+        for conv, offset in group.consumers:
+            mask(in_keep, conv, modules[conv].in_channels)[drop + offset] = False
+
+    for name in set(out_keep) | set(in_keep):
+        module = modules[name]
+        if isinstance(module, nn.BatchNorm2d):
+            _set_module(model, name, _new_bn(module, torch.from_numpy(out_keep[name])))
+        else:
+            out_mask = out_keep.get(name, np.ones(module.out_channels, dtype=bool))
+            in_mask = in_keep.get(name, np.ones(module.in_channels, dtype=bool))
+            _set_module(model, name, _new_conv(module, torch.from_numpy(out_mask), torch.from_numpy(in_mask)))
+    return model
+
+
+def model_report(model, dev_loader, device='cpu'):
+    # parameters, FLOPs and latency per image, dev loss
+    from benchmark import count_flops, measure_latency
+    from engine import evaluate
+    model.eval()
+    img = next(iter(dev_loader))[0][:1].to(device)
+    return {'params_M': sum(p.numel() for p in model.parameters()) / 1e6,
+            'gflops_per_image': count_flops(model, img) / 1e9,
+            'ms_per_image': measure_latency(model, img, repeats=5)['median_ms'],
+            'dev_loss': evaluate(model, dev_loader, device, verbose=False)}
+
+
+if __name__ == "__main__":
+    import argparse
+    import pandas as pd
+    from torch.utils.data import DataLoader, Subset
+    from dataset_class import CarDataset
+    from splits import load_splits
+    from model import load_model
+    from engine import train_epoch
+    parser = argparse.ArgumentParser(description='Prune ConvMultiRes channels and fine-tune')
+    parser.add_argument('--model', default='./model_test_org.pth')
+    parser.add_argument('--out', default='./model_pruned.pth')
+    parser.add_argument('--ratio', type=float, default=0.5, help='fraction of channels removed per group')
+    parser.add_argument('--method', choices=['bn', 'l1'], default='bn')
+    parser.add_argument('--targets', nargs='+', default=list(DEFAULT_TARGETS), choices=TARGETS)
+    parser.add_argument('--epochs', type=int, default=1, help='fine-tuning epochs')
+    parser.add_argument('--lr', type=float, default=1e-4)
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--train-images', type=int, default=None)
+    parser.add_argument('--dev-images', type=int, default=None)
+    parser.add_argument('--report', default='prune.csv')
+    args = parser.parse_args()
+
+    PATH = './Dataset/'
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    df_train, df_dev = load_splits(('train', 'dev'))
+    train_dataset = CarDataset(df_train, PATH + 'train_images/{}.jpg', training=True)
+    dev_dataset = CarDataset(df_dev, PATH + 'train_images/{}.jpg', training=False)
+    if args.train_images:
+        train_dataset = Subset(train_dataset, range(min(args.train_images, len(train_dataset))))
+    if args.dev_images:
+        dev_dataset = Subset(dev_dataset, range(min(args.dev_images, len(dev_dataset))))
+    train_loader = DataLoader(train_dataset, batch_size=args.batch, shuffle=True, num_workers=4)
+    dev_loader = DataLoader(dev_dataset, batch_size=args.batch, shuffle=False, num_workers=0)
+
+    model = load_model(args.model, device)
+    rows = [dict(stage='original', **model_report(model, dev_loader, device))]
+    print(rows[-1])
+    prune(model, args.ratio, args.method, args.targets)
+    rows.append(dict(stage='pruned', **model_report(model, dev_loader, device)))
+    print(rows[-1])
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=0.01)
+    for epoch in range(args.epochs):
+        train_epoch(model, train_loader, optimizer, device=device, epoch=epoch)
+    rows.append(dict(stage='fine-tuned', **model_report(model, dev_loader, device)))
+    print(rows[-1])
+    # the layer sizes no longer match ConvMultiRes(8), so save the whole module
+    torch.save(model, args.out)
+    pd.DataFrame(rows).to_csv(args.report, index=False)
+    print(pd.DataFrame(rows))
@@ -0,0 +1,145 @@
+##########################################################################
+# Batched 3D box rendering of car poses
+##########################################################################
+import os
+from multiprocessing import Pool
+import numpy as np
+import cv2
+from camera_model import load_camera
+from rotation import euler_to_rot_batch
+
+# tuning these numbers for a ideal car size
+X_L, Y_L, Z_L = 1.02, 0.80, 2.31
+# tuning this number for car height
+BOX_H = 3000
+# bottom corners of the box and the car center in the car frame
+BOX_POINTS = np.array([[X_L, -Y_L, -Z_L],
+                       [X_L, -Y_L, Z_L],
+                       [-X_L, -Y_L, Z_L],
+                       [-X_L, -Y_L, -Z_L],
+                       [0, 0, 0]])
+LINE_COLOR = (255, 0, 0)
+CENTER_COLOR = (255, 255, 0)
+# label / prediction string layouts
+TRAIN_NAMES = ('id', 'yaw', 'pitch', 'roll', 'x', 'y', 'z')
+PRED_NAMES = ('yaw', 'pitch', 'roll', 'x', 'y', 'z', 'confidence')
+
+
+def coords_to_array(coords):
+    # list of car dicts -> (N, 6) array of x, y, z, yaw, pitch, roll
+    return np.array([[c['x'], c['y'], c['z'], c['yaw'], c['pitch'], c['roll']]
+                     for c in coords], dtype='float64').reshape([-1, 6])
+
+
+def box_points(cars, camera=None):
+    # project the box corners and center of all N cars at once
+    # cars: (N, 6) array or list of car dicts; returns (N, 5, 3) int array of (u, v, depth)
+    camera = load_camera() if camera is None else camera
+    if not isinstance(cars, np.ndarray):
+        cars = coords_to_array(cars)
+    # same axis swap as mark_car / visualize: yaw, pitch, roll = -pitch, -yaw, -roll
+    rot = euler_to_rot_batch(-cars[:, 4], -cars[:, 3], -cars[:, 5])
+    pts = np.einsum('nji,mj->nmi', rot, BOX_POINTS) + cars[:, None, :3]
+    u, v = camera.project_xyz(pts[..., 0], pts[..., 1], pts[..., 2])
+    return np.stack([u, v, pts[..., 2]], -1).astype(int)
+
+
+def draw_cars(img, cars, camera=None, thickness=6):
+    # plot every car in the image with a box and a center point, one cv2.polylines call
+    img = img.copy()
+    pts = box_points(cars, camera)
+    if len(pts) == 0:
+        return img
+    bottom = pts[:, :4, :2]
+    top = np.stack([bottom[..., 0], (bottom[..., 1] - BOX_H / pts[:, :4, 2]).astype(int)], -1)
+    quads = np.concatenate([bottom, bottom[:, :1]], 1), np.concatenate([top, top[:, :1]], 1)
+    pillars = np.stack([top, bottom], 2).reshape([-1, 2, 2])
+    lines = list(quads[0]) + list(quads[1]) + list(pillars)
+    cv2.polylines(img, [l.astype(np.int32) for l in lines], False, LINE_COLOR, thickness)
+    for u, v, z in pts[:, 4]:
+        cv2.circle(img, (int(u), int(v)), int(800 / z), CENTER_COLOR, -1)
+    return img
+
+
+def parse_cars(s, names=PRED_NAMES):
+    # label / prediction string -> (N, 6) array, empty strings give no cars
+    if not isinstance(s, str) or not s.strip():
+        return np.zeros([0, 6])
+    values = np.array(s.split(), dtype='float64').reshape([-1, len(names)])
+    cols = [names.index(n) for n in ['x', 'y', 'z', 'yaw', 'pitch', 'roll']]
+    return values[:, cols]
+
+
+def _render_one(args):
+    img_path, s, names, thumb_width = args
+    img = cv2.imread(img_path)
+    if img is None:
+        return None
+    img = draw_cars(img, parse_cars(s, names))
+    thumb_height = int(round(img.shape[0] * thumb_width / img.shape[1]))
+    return cv2.resize(img, (thumb_width, thumb_height), interpolation=cv2.INTER_AREA)
+
+
+def _contact_sheet(thumbs, cols):
+    h, w = thumbs[0].shape[:2]
+    rows = (len(thumbs) + cols - 1) // cols
+    sheet = np.zeros([rows * h, cols * w, 3], dtype=np.uint8)
+    for i, t in enumerate(thumbs):
+        sheet[i // cols * h:(i // cols + 1) * h, i % cols * w:(i % cols + 1) * w] = t
+    return sheet
+
+
+def render_dir(predictions, image_dir, out, workers=4, thumb_width=640, cols=4, rows=4,
+               fps=5, names=PRED_NAMES, limit=None):
+    # draw all predictions of a csv (ImageId, PredictionString) in parallel
+    # out ending in .mp4/.avi -> one video, otherwise a directory of contact sheets
+    import pandas as pd
+    df = pd.read_csv(predictions)
+    if limit is not None:
+        df = df.iloc[:limit]
+    jobs = [(os.path.join(image_dir, img_id + '.jpg'), s, names, thumb_width)
+            for img_id, s in zip(df['ImageId'], df['PredictionString'])]
+    is_video = os.path.splitext(out)[1].lower() in ('.mp4', '.avi')
+    if not is_video:
+        os.makedirs(out, exist_ok=True)
+    writer = None
+    page = []
+    n_sheets = 0
+    with Pool(workers) as pool:
+        # imap keeps the order and only a few frames in flight
+        for thumb in pool.imap(_render_one, jobs, chunksize=4):
+            if thumb is None:
+                continue
+            if is_video:
+                if writer is None:
+                    fourcc = cv2.VideoWriter_fourcc(*('mp4v' if out.endswith('.mp4') else 'MJPG'))
+                    writer = cv2.VideoWriter(out, fourcc, fps, (thumb.shape[1], thumb.shape[0]))
+                writer.write(thumb)
+                continue
+            page.append(thumb)
+            if len(page) == cols * rows:
+                cv2.imwrite(os.path.join(out, 'sheet_{:04d}.jpg'.format(n_sheets)), _contact_sheet(page, cols))
+                n_sheets += 1
+                page = []
+    if page:
+        cv2.imwrite(os.path.join(out, 'sheet_{:04d}.jpg'.format(n_sheets)), _contact_sheet(page, cols))
+    if writer is not None:
+        writer.release()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Render predicted 3D boxes into contact sheets or a video')
+    parser.add_argument('predictions', help='csv with ImageId, PredictionString')
+    parser.add_argument('--images', default='Dataset/test_images/')
+    parser.add_argument('--out', default='renders/', help='directory for contact sheets or a .mp4/.avi file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--thumb-width', type=int, default=640)
+    parser.add_argument('--cols', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=4)
+    parser.add_argument('--fps', type=int, default=5)
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--labels', action='store_true', help='train.csv layout (id first) instead of predictions')
+    args = parser.parse_args()
+    render_dir(args.predictions, args.images, args.out, args.workers, args.thumb_width, args.cols,
+               args.rows, args.fps, TRAIN_NAMES if args.labels else PRED_NAMES, args.limit)
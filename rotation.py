@@ -0,0 +1,63 @@
+##########################################################################
+# Batched Euler angle <-> rotation matrix conversions (numpy and torch)
+#
+# R = Y(yaw) . P(pitch) . R(roll), with Y about the y axis, P about x and
+# R about z, same as euler_to_rot / euler2mat
+##########################################################################
+import numpy as np
+import torch
+
+
+def _rot_entries(cy, sy, cp, sp, cr, sr):
+    # the nine entries of Y . P . R in row-major order
+    return [cy * cr + sy * sp * sr, -cy * sr + sy * sp * cr, sy * cp,
+            cp * sr, cp * cr, -sp,
+            -sy * cr + cy * sp * sr, sy * sr + cy * sp * cr, cy * cp]
+
+
+def euler_to_rot_batch(yaw, pitch, roll):
+    # arrays of angles (any shape S) -> S x 3 x 3 rotation matrices
+    yaw, pitch, roll = np.broadcast_arrays(np.asarray(yaw, dtype='float64'),
+                                           np.asarray(pitch, dtype='float64'),
+                                           np.asarray(roll, dtype='float64'))
+    entries = _rot_entries(np.cos(yaw), np.sin(yaw), np.cos(pitch), np.sin(pitch),
+                           np.cos(roll), np.sin(roll))
+    return np.stack(entries, -1).reshape(yaw.shape + (3, 3))
+
+
+def euler_to_rot_torch(yaw, pitch, roll):
+    # torch version, differentiable, keeps dtype and device of the inputs
+    yaw, pitch, roll = torch.broadcast_tensors(yaw, pitch, roll)
+    entries = _rot_entries(torch.cos(yaw), torch.sin(yaw), torch.cos(pitch), torch.sin(pitch),
+                           torch.cos(roll), torch.sin(roll))
+    return torch.stack(entries, -1).reshape(yaw.shape + (3, 3))
+
+
+def rot_to_euler(rot):
+    # S x 3 x 3 rotation matrices -> yaw, pitch, roll arrays of shape S
+    # pitch comes back in [-pi/2, pi/2], which is where the P rotation of the labels lives
+    rot = np.asarray(rot, dtype='float64')
+    pitch = np.arcsin(np.clip(-rot[..., 1, 2], -1, 1))
+    yaw = np.arctan2(rot[..., 0, 2], rot[..., 2, 2])
+    roll = np.arctan2(rot[..., 1, 0], rot[..., 1, 1])
+    return yaw, pitch, roll
+
+
+def rot_to_euler_torch(rot):
+    pitch = torch.asin(torch.clamp(-rot[..., 1, 2], -1, 1))
+    yaw = torch.atan2(rot[..., 0, 2], rot[..., 2, 2])
+    roll = torch.atan2(rot[..., 1, 0], rot[..., 1, 1])
+    return yaw, pitch, roll
+
+
+def rotation_distance(rot1, rot2):
+    # angle in radians of the relative rotation rot1^T . rot2, elementwise over the batch
+    # (the rotation error of the mAP metric)
+    cos = (np.einsum('...ji,...ji->...', rot1, rot2) - 1) / 2
+    return np.arccos(np.clip(cos, -1, 1))
+
+
+def rotation_distance_torch(rot1, rot2):
+    cos = ((rot1 * rot2).sum((-2, -1)) - 1) / 2
+    # clamp a bit inside [-1, 1] so acos stays differentiable for a rotation loss
+    return torch.acos(torch.clamp(cos, -1 + 1e-7, 1 - 1e-7))
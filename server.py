@@ -0,0 +1,204 @@
+##########################################################################
+# Local HTTP inference service with dynamic request batching
+#
+#   python server.py --model model_test_org.pth --port 8000
+#   curl --data-binary @Dataset/test_images/ID_18fb86d04.jpg localhost:8000/predict
+#   curl localhost:8000/stats
+##########################################################################
+import collections
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import cv2
+import torch
+from helper_functions import img_preprocess
+from decode import predict, decode_coords, coords_to_json
+from ground_plane import load_ground_plane, GROUND_PLANE_FILE
+from model import load_model
+
+
+class _Request:
+    def __init__(self, img):
+        self.img = img
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+
+class BatchingPredictor:
+    '''Groups concurrent requests into one forward pass'''
+    '''a batch is closed when it is full or the oldest request waited max_latency_ms'''
+
+    def __init__(self, model, xzy_slope, device='cpu', max_batch=8, max_latency_ms=20,
+                 flip_tta=False, threshold=0, top_k=100, history=10000):
+        self.model = model
+        self.xzy_slope = xzy_slope
+        self.device = device
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000
+        self.flip_tta = flip_tta
+        self.threshold = threshold
+        self.top_k = top_k
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # recent per-request timings in ms, bounded
+        self.latency = collections.deque(maxlen=history)
+        self.queue_wait = collections.deque(maxlen=history)
+        self.batch_sizes = collections.Counter()
+        self.n_requests = 0
+        self.n_errors = 0
+        self.worker = threading.Thread(target=self._loop, daemon=True)
+        self.worker.start()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].arrival + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            start = time.time()
+            try:
+                img = torch.from_numpy(np.stack([np.rollaxis(r.img, 2, 0) for r in batch]))
+                output = predict(self.model, img.to(self.device), flip_tta=self.flip_tta).cpu()
+                for r, out in zip(batch, output):
+                    r.output = out
+            except Exception as e:
+                for r in batch:
+                    r.error = e
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+                self.queue_wait.extend((start - r.arrival) * 1000 for r in batch)
+            for r in batch:
+                r.done.set()
+
+    def __call__(self, img):
+        # raw BGR image -> list of car dicts; decoding runs in the calling thread,
+        # so the batching thread is free for the next forward pass
+        r = _Request(img_preprocess(img))
+        self.queue.put(r)
+        r.done.wait()
+        try:
+            if r.error is not None:
+                raise r.error
+            coords = decode_coords(r.output[None], self.xzy_slope, self.threshold, self.top_k)[0]
+        except Exception:
+            with self.lock:
+                self.n_errors += 1
+            raise
+        with self.lock:
+            self.n_requests += 1
+            self.latency.append((time.time() - r.arrival) * 1000)
+        return coords
+
+    def stats(self):
+        with self.lock:
+            latency = np.array(self.latency)
+            queue_wait = np.array(self.queue_wait)
+            batch_sizes = dict(self.batch_sizes)
+            stats = {'requests': self.n_requests, 'errors': self.n_errors,
+                     'batches': sum(batch_sizes.values()), 'batch_sizes': batch_sizes}
+        n_batched = sum(k * v for k, v in batch_sizes.items())
+        stats['mean_batch_size'] = n_batched / max(1, stats['batches'])
+        for name, values in [('latency_ms', latency), ('queue_wait_ms', queue_wait)]:
+            if len(values):
+                stats[name] = {'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)),
+                               'p99': float(np.percentile(values, 99)), 'max': float(values.max())}
+        return stats
+
+
+class _Handler(BaseHTTPRequestHandler):
+    predictor = None
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.predictor.stats())
+        elif self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': 'unknown path ' + self.path})
+            return
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            self._reply(400, {'error': 'body is not a readable image'})
+            return
+        try:
+            self._reply(200, coords_to_json(self.predictor(img)))
+        except Exception as e:
+            self._reply(500, {'error': repr(e)})
+
+    def log_message(self, format, *args):
+        # one line per request on stderr is too noisy under load
+        pass
+
+
+def make_server(predictor, host='127.0.0.1', port=8000):
+    # port=0 picks a free port, see server.server_address
+    handler = type('Handler', (_Handler,), {'predictor': predictor})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def post_image(url, path):
+    # small client for other tools: POST a JPEG file, return the decoded JSON
+    import urllib.request
+    with open(path, 'rb') as f:
+        request = urllib.request.Request(url, data=f.read(), headers={'Content-Type': 'image/jpeg'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve pose estimates for single frames')
+    parser.add_argument('--model', default='./model_test_org.pth')
+    parser.add_argument('--ground-plane', default=GROUND_PLANE_FILE)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--max-latency-ms', type=float, default=20)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--flip-tta', action='store_true')
+    parser.add_argument('--optimize', action='store_true',
+                        help='fold BN / fuse conv+ReLU / channels_last and use the threads tuned by optimize.py')
+    args = parser.parse_args()
+
+    if args.optimize:
+        from optimize import optimize_for_inference, apply_inference_config
+        apply_inference_config(batch_size=args.max_batch)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = load_model(args.model, device)
+    if args.optimize:
+        optimize_for_inference(model)
+    predictor = BatchingPredictor(model, load_ground_plane(path=args.ground_plane),
+                                  device, args.max_batch, args.max_latency_ms, args.flip_tta)
+    server = make_server(predictor, args.host, args.port)
+    print('Serving on http://{}:{}'.format(*server.server_address))
+    server.serve_forever()
@@ -0,0 +1,159 @@
+##########################################################################
+# Train / dev / test split manifests
+#
+#   python splits.py --workers 4        # check the images, write Dataset/splits/
+#   df_train, df_dev, df_test = load_splits()
+#
+# The images of train.csv and sample_submission.csv are checked once:
+# present, a complete JPEG, decoding to the raw camera size. The bad ones
+# and the known damaged IMG_DAMAGED are dropped and the rest of train.csv
+# is split with train_dev_split. Each split is written as a CSV next to
+# manifest.json, which records the md5 of every split file and of the
+# source CSVs and why each image was dropped.
+# load_splits only reads the small CSVs. It rebuilds them when a source CSV
+# changed, so the caches keyed by split content (cache.ImageCache,
+# cache.dev_cache_path) stay valid from run to run.
+##########################################################################
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+DATA_DIR = './Dataset/'
+SPLIT_DIR = DATA_DIR + 'splits/'
+SPLITS = ('train', 'dev', 'test')
+# source CSV and image folder of the labelled and the test images
+SOURCES = {'train': ('train.csv', 'train_images/{}.jpg'),
+           'test': ('sample_submission.csv', 'test_images/{}.jpg')}
+DEV_SIZE = 0.01
+SEED = 231
+# damaged images of train.csv whose files may well decode, always left out on top of the checks
+IMG_DAMAGED = ['ID_1a5a10365', 'ID_4d238ae90', 'ID_408f58e9f', 'ID_bb1d991f6', 'ID_c44983aeb']
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def check_image(path):
+    # None for a complete jpg of the raw camera size, otherwise what is wrong with it
+    import cv2
+    from camera_model import IMG_SHAPE
+    if not os.path.exists(path):
+        return 'missing'
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(b'\xff\xd8'):
+        return 'not a jpeg'
+    # end of image marker, a cut off file still decodes with a grey bottom
+    if b'\xff\xd9' not in data[-64:]:
+        return 'truncated'
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return 'unreadable'
+    if img.shape[:2] != IMG_SHAPE:
+        return 'size {}x{}'.format(img.shape[1], img.shape[0])
+    return None
+
+
+def validate_images(image_ids, root_dir, workers=4):
+    # {image id: problem} of the images of image_ids that can not be used
+    paths = [root_dir.format(img_id) for img_id in image_ids]
+    if workers > 1:
+        import multiprocessing
+        with multiprocessing.Pool(workers) as pool:
+            problems = pool.map(check_image, paths, chunksize=16)
+    else:
+        problems = [check_image(path) for path in paths]
+    return {img_id: problem for img_id, problem in zip(image_ids, problems) if problem}
+
+
+def _write(path, write):
+    # through a temporary file per process, a reader (or another rank) never sees half a file
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def build_splits(data_dir=DATA_DIR, split_dir=SPLIT_DIR, dev_size=DEV_SIZE, seed=SEED, workers=4,
+                 exclude=IMG_DAMAGED):
+    # check every image, drop the bad ones (and exclude), write the split CSVs and manifest.json
+    from dataset_class import train_dev_split
+    frames, dropped = {}, {}
+    for name, (csv, images) in SOURCES.items():
+        df = pd.read_csv(data_dir + csv)
+        dropped[name] = validate_images(df['ImageId'], data_dir + images, workers)
+        ids = set(df['ImageId'])
+        dropped[name].update({img_id: 'excluded' for img_id in exclude if img_id in ids})
+        frames[name] = df[~df['ImageId'].isin(dropped[name])]
+    df_train, df_dev = train_dev_split(frames['train'], dev_size, seed)
+
+    os.makedirs(split_dir, exist_ok=True)
+    manifest = {'sources': {csv: file_md5(data_dir + csv) for csv, _ in SOURCES.values()},
+                'dev_size': dev_size, 'seed': seed, 'exclude': list(exclude), 'dropped': dropped, 'splits': {}}
+    for name, df in zip(SPLITS, (df_train, df_dev, frames['test'])):
+        path = os.path.join(split_dir, name + '.csv')
+        _write(path, lambda tmp: df.to_csv(tmp, index=False))
+        manifest['splits'][name] = {'file': name + '.csv', 'rows': len(df), 'md5': file_md5(path)}
+
+    def dump(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+    _write(os.path.join(split_dir, 'manifest.json'), dump)
+    return manifest
+
+
+def load_manifest(split_dir=SPLIT_DIR):
+    path = os.path.join(split_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def is_current(manifest, data_dir=DATA_DIR, split_dir=SPLIT_DIR):
+    # the source CSVs and the split files are still the ones the manifest was built from
+    if manifest is None:
+        return False
+    for csv, md5 in manifest['sources'].items():
+        if not os.path.exists(data_dir + csv) or file_md5(data_dir + csv) != md5:
+            return False
+    for split in manifest['splits'].values():
+        path = os.path.join(split_dir, split['file'])
+        if not os.path.exists(path) or file_md5(path) != split['md5']:
+            return False
+    return True
+
+
+def load_splits(names=SPLITS, data_dir=DATA_DIR, split_dir=SPLIT_DIR, workers=4):
+    # DataFrames (ImageId, PredictionString) of the splits in names, built first if needed
+    manifest = load_manifest(split_dir)
+    if not is_current(manifest, data_dir, split_dir):
+        print('Checking the images and writing the split manifest to {}'.format(split_dir))
+        params = {} if manifest is None else {k: manifest[k] for k in ('dev_size', 'seed', 'exclude')}
+        manifest = build_splits(data_dir, split_dir, workers=workers, **params)
+    return tuple(pd.read_csv(os.path.join(split_dir, manifest['splits'][name]['file'])) for name in names)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Check the images and write the train / dev / test split files')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--split-dir', default=SPLIT_DIR)
+    parser.add_argument('--dev-size', type=float, default=DEV_SIZE)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--exclude', nargs='*', default=IMG_DAMAGED, help='image ids to leave out as well')
+    args = parser.parse_args()
+
+    manifest = build_splits(args.data_dir, args.split_dir, args.dev_size, args.seed, args.workers, args.exclude)
+    for name, split in manifest['splits'].items():
+        print('{:<6s}{:>6d} images  md5 {}'.format(name, split['rows'], split['md5']))
+    for name, dropped in manifest['dropped'].items():
+        for img_id, problem in sorted(dropped.items()):
+            print('dropped {} image {}: {}'.format(name, img_id, problem))
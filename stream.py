@@ -0,0 +1,163 @@
+##########################################################################
+# Streaming inference over a directory glob or a video file
+#
+#   python stream.py 'Dataset/test_images/*.jpg' --out detections.ndjson
+#   python stream.py drive.mp4 > detections.ndjson
+#   python stream.py drive.mp4 --model a.pth b.pth    # ensemble, see ensemble.py
+#
+# Frames are decoded in background threads into a bounded queue, the model
+# runs on fixed-size batches and every frame becomes one JSON line, so memory
+# stays flat however long the input is.
+##########################################################################
+import collections
+import glob
+import json
+import os
+import sys
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import torch
+from helper_functions import img_preprocess
+from decode import predict, decode_coords, coords_to_json
+from ground_plane import load_ground_plane, GROUND_PLANE_FILE
+from ensemble import load_ensemble
+
+VIDEO_EXT = ('.mp4', '.avi', '.mov', '.mkv')
+_END = object()
+
+
+def _read_image(path):
+    img = cv2.imread(path)
+    return None if img is None else img_preprocess(img)
+
+
+def image_frames(pattern, workers=4, prefetch=16):
+    # (source, preprocessed frame) in glob order, decoded by a thread pool
+    # with at most prefetch frames in flight
+    paths = sorted(glob.glob(pattern))
+    pending = collections.deque()
+    with ThreadPoolExecutor(workers) as pool:
+        for path in paths:
+            pending.append((path, pool.submit(_read_image, path)))
+            if len(pending) >= prefetch:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+def video_frames(path, prefetch=16):
+    # (frame index, preprocessed frame) decoded by a background thread into a bounded queue
+    frames = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def reader():
+        capture = cv2.VideoCapture(path)
+        idx = 0
+        try:
+            while not stop.is_set():
+                ok, img = capture.read()
+                if not ok:
+                    break
+                frames.put((idx, img_preprocess(img)))
+                idx += 1
+        finally:
+            capture.release()
+            frames.put(_END)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = frames.get()
+            if item is _END:
+                break
+            yield item
+    finally:
+        # consumer gone early: let the reader finish instead of blocking on a full queue
+        stop.set()
+        while thread.is_alive():
+            try:
+                frames.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def frames_from(source, workers=4, prefetch=16):
+    if os.path.splitext(source)[1].lower() in VIDEO_EXT and os.path.isfile(source):
+        return video_frames(source, prefetch)
+    return image_frames(source, workers, prefetch)
+
+
+def _batches(frames, batch_size):
+    batch = []
+    for item in frames:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stream_predict(model, xzy_slope, source, out=sys.stdout, batch_size=4, device='cpu', workers=4,
+                   prefetch=16, flip_tta=False, threshold=0, top_k=100):
+    # write one JSON line per frame: {"frame", "source", "PredictionString", "detections"}
+    n = 0
+    for batch in _batches(frames_from(source, workers, prefetch), batch_size):
+        # unreadable files are reported without running the model
+        imgs = [np.rollaxis(img, 2, 0) for _, img in batch if img is not None]
+        coords = []
+        if imgs:
+            output = predict(model, torch.from_numpy(np.stack(imgs)).to(device), flip_tta=flip_tta)
+            coords = decode_coords(output, xzy_slope, threshold, top_k)
+        coords = iter(coords)
+        for src, img in batch:
+            line = {'frame': n, 'source': src}
+            if img is None:
+                line['error'] = 'unreadable image'
+            else:
+                line.update(coords_to_json(next(coords)))
+            out.write(json.dumps(line) + '\n')
+            n += 1
+        out.flush()
+    return n
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Detections as newline-delimited JSON for a glob or a video')
+    parser.add_argument('source', help="glob of images (quote it) or a video file")
+    parser.add_argument('--model', nargs='+', default=['./model_test_org.pth'],
+                        help='several checkpoints are averaged')
+    parser.add_argument('--parallel', action='store_true', help='one CPU process per ensemble member')
+    parser.add_argument('--ground-plane', default=GROUND_PLANE_FILE)
+    parser.add_argument('--out', default='-', help='output file, - for stdout')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=4, help='image decoding threads')
+    parser.add_argument('--prefetch', type=int, default=16, help='decoded frames kept in memory')
+    parser.add_argument('--flip-tta', action='store_true')
+    parser.add_argument('--optimize', action='store_true',
+                        help='fold BN / fuse conv+ReLU / channels_last and use the threads tuned by optimize.py')
+    args = parser.parse_args()
+
+    if args.optimize:
+        from optimize import apply_inference_config
+        apply_inference_config(batch_size=args.batch_size)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = load_ensemble(args.model, device, parallel=args.parallel, optimize=args.optimize)
+    xzy_slope = load_ground_plane(path=args.ground_plane)
+    out = sys.stdout if args.out == '-' else open(args.out, 'w')
+    try:
+        n = stream_predict(model, xzy_slope, args.source, out, args.batch_size, device, args.workers,
+                           args.prefetch, args.flip_tta)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if hasattr(model, 'close'):
+            model.close()
+    print('{} frames'.format(n), file=sys.stderr)
@@ -0,0 +1,198 @@
+##########################################################################
+# Parallel hyperparameter sweep
+#
+#   python sweep.py --dropout-rate 0.0 0.3 --lr 1e-3 3e-4 --epochs 4 --train-images 400
+#
+# Every combination of DROPOUT_RATE, EFFNET_VER, lr, weight_decay and the
+# loss weight gamma is one trial. Trials run as concurrent processes (as
+# many as the cores allow at --threads each) and read their inputs from the
+# per-resolution memmap caches of cache.py, built once before the first
+# trial starts. After each epoch a trial whose dev loss is worse than the
+# median of the other trials at that epoch is stopped (median stopping
+# rule). All trials end up in one CSV table sorted by dev loss; a trial that
+# crashes or is killed (out of memory: lower --processes) is a row with its error.
+##########################################################################
+import itertools
+import os
+import time
+import numpy as np
+import torch
+from loss import GAMMA
+
+# the values of the README runs, each a list of values to sweep
+SPACE = {
+    'dropout_rate': [0.3],
+    'effnet_ver': ['b0'],
+    'lr': [1e-3],
+    'weight_decay': [0.01],
+    'gamma': [GAMMA],
+}
+SWEEP_DIR = './sweeps/'
+
+
+def trials(space):
+    # one dict of parameters per combination of the values in space
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[n] for n in names])]
+
+
+def apply_dropout(model, rate):
+    # DROPOUT_RATE for every nn.Dropout and the drop connect (stochastic depth) rate of
+    # the EfficientNet blocks, the only dropout on the path extract_features takes
+    for module in model.modules():
+        if isinstance(module, torch.nn.Dropout):
+            module.p = rate
+        params = getattr(module, '_global_params', None)
+        if params is not None and hasattr(params, 'drop_connect_rate'):
+            module._global_params = params._replace(drop_connect_rate=rate)
+    return model
+
+
+def should_stop(board, lock, trial_id, epoch, loss, min_trials=2):
+    # record the dev loss of trial_id at epoch, True when it is behind the median of the
+    # other trials that reached this epoch (at least min_trials of them)
+    with lock:
+        losses = dict(board.get(epoch, {}))
+        losses[trial_id] = loss
+        board[epoch] = losses
+    others = [v for k, v in losses.items() if k != trial_id]
+    return len(others) >= min_trials and loss > float(np.median(others))
+
+
+def run_trial(job):
+    # one trial in a worker process, returns its row of the results table
+    from torch.utils.data import DataLoader
+    from dataset_class import CarDataset
+    from cache import materialize, dev_cache_path
+    from model import ConvMultiRes
+    from engine import train_epoch, evaluate
+    trial_id, params, data, board, lock, args = job
+    torch.set_num_threads(args['threads'])
+    torch.manual_seed(args['seed'])
+    np.random.seed(args['seed'])
+    df_train, df_dev, root_dir, cache_dir, res = data
+    train_loader = DataLoader(CarDataset(df_train, root_dir, training=True, res=res, cache_dir=cache_dir),
+                              batch_size=args['batch'], shuffle=True, num_workers=args['loader_workers'])
+    dev_dataset = materialize(CarDataset(df_dev, root_dir, training=False, res=res, cache_dir=cache_dir),
+                              dev_cache_path(df_dev, res, cache_dir))
+    dev_loader = DataLoader(dev_dataset, batch_size=args['batch'], shuffle=False, num_workers=args['loader_workers'])
+
+    model = ConvMultiRes(8, 'efficientnet-' + params['effnet_ver'])
+    apply_dropout(model, params['dropout_rate'])
+    optimizer = torch.optim.Adam(model.parameters(), lr=params['lr'], weight_decay=params['weight_decay'])
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=max(args['epochs'], 10) * len(train_loader) // 3,
+                                                gamma=0.1)
+    row = dict(trial=trial_id, **params)
+    start = time.time()
+    losses = []
+    for epoch in range(args['epochs']):
+        train_epoch(model, train_loader, optimizer, scheduler, epoch=epoch, verbose=False, gamma=params['gamma'])
+        # dev loss at the default gamma so trials with different gamma stay comparable
+        losses.append(evaluate(model, dev_loader, epoch=epoch, verbose=False))
+        row['dev_loss_epoch{}'.format(epoch)] = losses[-1]
+        print('trial {} epoch {}: dev loss {:.4f} {}'.format(trial_id, epoch, losses[-1], params), flush=True)
+        if epoch + 1 < args['epochs'] and should_stop(board, lock, trial_id, epoch, losses[-1], args['min_trials']):
+            row['stopped_early'] = True
+            break
+    row.setdefault('stopped_early', False)
+    row.update(epochs=len(losses), dev_loss=min(losses), best_epoch=int(np.argmin(losses)),
+               train_minutes=(time.time() - start) / 60)
+    if args['save_models']:
+        torch.save(model.state_dict(), os.path.join(args['out_dir'], 'trial_{}.pth'.format(trial_id)))
+    return row
+
+
+def _trial_process(job, results):
+    # a trial in its own process; a trial that crashes (or runs out of memory) is only a failed row
+    trial_id, params = job[:2]
+    try:
+        results[trial_id] = run_trial(job)
+    except Exception as e:
+        results[trial_id] = dict(trial=trial_id, error=repr(e), **params)
+
+
+def run_sweep(space, df_train, df_dev, root_dir, epochs=4, threads=1, processes=None, batch=4,
+              cache_dir=None, loader_workers=0, min_trials=2, seed=0, out_dir=SWEEP_DIR, save_models=False,
+              scale=1.0):
+    # run every trial of space, returns the results table (also written to out_dir/results.csv)
+    # scale: input resolution of the trials (camera_model.Resolution.scaled), lower for quick sweeps
+    import multiprocessing
+    from multiprocessing.connection import wait
+    import pandas as pd
+    from cache import build_cache, materialize, dev_cache_path, CACHE_DIR
+    from dataset_class import CarDataset
+    from camera_model import Resolution
+    os.makedirs(out_dir, exist_ok=True)
+    cache_dir = cache_dir or CACHE_DIR
+    res = Resolution.scaled(scale)
+    # the preprocessed images are decoded once here and shared by all trials through the page cache
+    for df in (df_train, df_dev):
+        build_cache(df['ImageId'], root_dir, res, cache_dir)
+    # and the dev targets too, each trial maps the same files
+    materialize(CarDataset(df_dev, root_dir, training=False, res=res, cache_dir=cache_dir),
+                dev_cache_path(df_dev, res, cache_dir))
+
+    params = trials(space)
+    processes = processes or max(1, min(len(params), (os.cpu_count() or 1) // threads))
+    args = dict(epochs=epochs, threads=threads, batch=batch, loader_workers=loader_workers, min_trials=min_trials,
+                seed=seed, out_dir=out_dir, save_models=save_models)
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Manager() as manager:
+        board, lock, results = manager.dict(), manager.Lock(), manager.dict()
+        pending = [(i, p, (df_train, df_dev, root_dir, cache_dir, res), board, lock, args)
+                   for i, p in enumerate(params)]
+        running = {}
+        # one process per trial, at most `processes` at a time
+        while pending or running:
+            while pending and len(running) < processes:
+                job = pending.pop(0)
+                running[job[0]] = ctx.Process(target=_trial_process, args=(job, results))
+                running[job[0]].start()
+            wait([p.sentinel for p in running.values()])
+            for trial_id, p in list(running.items()):
+                if not p.is_alive():
+                    p.join()
+                    del running[trial_id]
+                    if trial_id not in results:
+                        results[trial_id] = dict(trial=trial_id, error='exit code {}'.format(p.exitcode),
+                                                 **params[trial_id])
+        rows = [results[i] for i in range(len(params))]
+    table = pd.DataFrame(rows)
+    table = table.sort_values('dev_loss') if 'dev_loss' in table else table
+    table.to_csv(os.path.join(out_dir, 'results.csv'), index=False)
+    return table
+
+
+if __name__ == "__main__":
+    import argparse
+    from splits import load_splits
+    parser = argparse.ArgumentParser(description='Sweep hyperparameters with concurrent trials and early stopping')
+    parser.add_argument('--dropout-rate', type=float, nargs='+', default=SPACE['dropout_rate'])
+    parser.add_argument('--effnet-ver', nargs='+', default=SPACE['effnet_ver'])
+    parser.add_argument('--lr', type=float, nargs='+', default=SPACE['lr'])
+    parser.add_argument('--weight-decay', type=float, nargs='+', default=SPACE['weight_decay'])
+    parser.add_argument('--gamma', type=float, nargs='+', default=SPACE['gamma'])
+    parser.add_argument('--epochs', type=int, default=4)
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--scale', type=float, default=1.0, help='input resolution, x 1024x320')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per trial')
+    parser.add_argument('--processes', type=int, default=None, help='concurrent trials, cores / threads by default')
+    parser.add_argument('--loader-workers', type=int, default=0)
+    parser.add_argument('--min-trials', type=int, default=2,
+                        help='other trials needed at an epoch before the median rule stops one')
+    parser.add_argument('--train-images', type=int, default=None)
+    parser.add_argument('--dev-images', type=int, default=None)
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--out-dir', default=SWEEP_DIR)
+    parser.add_argument('--save-models', action='store_true')
+    args = parser.parse_args()
+
+    PATH = './Dataset/'
+    df_train, df_dev = load_splits(('train', 'dev'))
+    df_train, df_dev = df_train[:args.train_images], df_dev[:args.dev_images]
+    space = {'dropout_rate': args.dropout_rate, 'effnet_ver': args.effnet_ver, 'lr': args.lr,
+             'weight_decay': args.weight_decay, 'gamma': args.gamma}
+    table = run_sweep(space, df_train, df_dev, PATH + 'train_images/{}.jpg', args.epochs, args.threads,
+                      args.processes, args.batch, args.cache_dir, args.loader_workers, args.min_trials,
+                      out_dir=args.out_dir, save_models=args.save_models, scale=args.scale)
+    print(table.to_string(index=False))
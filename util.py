@@ -1,12 +1,13 @@
 import numpy as np
 from math import sin, cos
-from scipy.optimize import minimize
+from camera_model import load_camera, Camera, Resolution, IMG_WIDTH, IMG_HEIGHT, MODEL_SCALE, \
+    DEFAULT_RESOLUTION
+from camera_model import IMG_SHAPE as RAW_SHAPE
+from rotation import euler_to_rot_batch
 PATH = 'Dataset/'
 
-IMG_WIDTH = 1024
-IMG_HEIGHT = IMG_WIDTH // 16 * 5
-IMG_SHAPE = (3384, 2710)
-MODEL_SCALE = 8
+# raw image (width, height)
+IMG_SHAPE = RAW_SHAPE[::-1]
 
 
 def str2coords(s, names=('id', 'yaw', 'pitch', 'roll', 'x', 'y', 'z')):
@@ -20,38 +21,23 @@ def str2coords(s, names=('id', 'yaw', 'pitch', 'roll', 'x', 'y', 'z')):
     return coords
 
 
-def coords2img(s, camera_mat):
+def coords2img(s, camera_mat=None):
     # use camera matrix to get the car location in image coordinates
-    coords = str2coords(s)
-    xs, ys, zs = [], [], []
-    for coord in coords:
-        xs.append(coord['x'])
-        ys.append(coord['y'])
-        zs.append(coord['z'])
-    p = np.array(list(zip(xs, ys, zs))).T
-    pos = camera_mat.dot(p).T
-    img_x = pos[:, 0] / pos[:, 2]
-    img_y = pos[:, 1] / pos[:, 2]
+    camera = load_camera() if camera_mat is None else Camera.from_matrix(camera_mat)
+    p = np.array([[c['x'], c['y'], c['z']] for c in str2coords(s)]).reshape([-1, 3])
+    img_x, img_y = camera.project_xyz(p[:, 0], p[:, 1], p[:, 2])
     return img_x, img_y
 
 
 def euler2mat(yaw, pitch, roll):
-    y = np.array([[cos(yaw), 0, sin(yaw)],
-                  [0, 1, 0],
-                  [-sin(yaw), 0, cos(yaw)]])
-    p = np.array([[1, 0, 0],
-                  [0, cos(pitch), -sin(pitch)],
-                  [0, sin(pitch), cos(pitch)]])
-    r = np.array([[cos(roll), -sin(roll), 0],
-                  [sin(roll), cos(roll), 0],
-                  [0, 0, 1]])
-    return y.dot(p.dot(r))
+    # also takes arrays of angles and returns an Nx3x3 stack, see rotation.py
+    return euler_to_rot_batch(yaw, pitch, roll)
 
 DISTANCE_THRESH_CLEAR = 2
 
-def convert_3d_to_2d(x, y, z, fx = 2304.5479, fy = 2305.8757, cx = 1686.2379, cy = 1354.9849):
+def convert_3d_to_2d(x, y, z):
     # stolen from https://www.kaggle.com/theshockwaverider/eda-visualization-baseline
-    return x * fx / z + cx, y * fy / z + cy
+    return load_camera().project_xyz(x, y, z)
 
 def clear_duplicates(coords):
     for c1 in coords:
@@ -65,24 +51,33 @@ def clear_duplicates(coords):
     return [c for c in coords if c['confidence'] > 0]
 
 
-def optimize_xy(r, c, x0, y0, z0, slope):
+def optimize_xy(r, c, x0, y0, z0, slope, res=DEFAULT_RESOLUTION):
+    # scipy is only needed when decoding, not on import
+    from scipy.optimize import minimize
+    # evaluate the plane with plain arithmetic, sklearn predict is slow inside Powell
+    a, b = slope.coef_
+    intercept = slope.intercept_
+    camera = load_camera()
+
     def distance_fn(xyz):
         x, y, z = xyz
-        slope_err = (slope.predict([[x, z]])[0] - y) ** 2
-        x, y = convert_3d_to_2d(x, y, z)
-        y, x = x, y
-        x = (x - IMG_SHAPE[0] // 2) * IMG_HEIGHT / (IMG_SHAPE[0] // 2) / MODEL_SCALE
-        y = (y + IMG_SHAPE[1] // 6) * IMG_WIDTH / (IMG_SHAPE[1] * 4 / 3) / MODEL_SCALE
+        slope_err = (a * x + b * z + intercept - y) ** 2
+        u, v = camera.project_xyz(x, y, z)
+        x, y = camera.to_grid(u, v, RAW_SHAPE, *res)
         return max(0.2, (x - r) ** 2 + (y - c) ** 2) + max(0.4, slope_err)
 
     res = minimize(distance_fn, [x0, y0, z0], method='Powell')
     x_new, y_new, z_new = res.x
     return x_new, y_new, z_new
 
-def get_coords(pred, slope, threshold=0):
+def get_coords(pred, slope, threshold=0, points=None, res=None):
+    # points: candidate (row, col) cells, e.g. from decode.extract_peaks
+    # res: network resolution, by default the one whose output grid matches pred
+    res = res or Resolution.from_grid(pred.shape[-2:])
     logits = pred[0]
     regr_output = pred[1:]
-    points = np.argwhere(logits > -0.5)
+    if points is None:
+        points = np.argwhere(logits > threshold)
     col_names = sorted(['x', 'y', 'z', 'yaw', 'pitch_sin', 'pitch_cos', 'roll'])
     coords = []
     for r, c in points:
@@ -90,7 +85,7 @@ def get_coords(pred, slope, threshold=0):
         coords.append(regr_back(regr_dict))
         coords[-1]['confidence'] = 1 / (1 + np.exp(-logits[r, c]))
         coords[-1]['x'], coords[-1]['y'], coords[-1]['z'] = \
-            optimize_xy(r, c, coords[-1]['x'], coords[-1]['y'], coords[-1]['z'], slope)
+            optimize_xy(r, c, coords[-1]['x'], coords[-1]['y'], coords[-1]['z'], slope, res)
     coords = clear_duplicates(coords)
     return coords
 
@@ -132,29 +127,24 @@ def carinfo_cleanup(pose):
     return pose
 
 
-def car_center(img, labels, camera):
+def car_center(img, labels, camera, res=DEFAULT_RESOLUTION):
     """
     Input:
-    image, labels, camera info
+    raw image (or its shape), labels, camera info, network resolution
     Output:
     mask matrix, pose info matrix (7 layers)
     """
-    modelHeight = IMG_HEIGHT // MODEL_SCALE
-    modelWidth = IMG_WIDTH // MODEL_SCALE
+    img_shape = img if isinstance(img, tuple) else img.shape
+    modelHeight, modelWidth = res.grid
     mask = np.zeros([modelHeight, modelWidth], dtype='float32')
     # regr_names = ['x', 'y', 'z', 'yaw', 'pitch', 'roll']
     info = np.zeros([modelHeight, modelWidth, 7], dtype='float32')
     car_pose = str2coords(labels)
     xs, ys = coords2img(labels, camera)
+    rows, cols = Camera.from_matrix(camera).to_grid(xs, ys, img_shape, *res)
     for i in range(len(car_pose)):
-        x = (xs[i] + img.shape[1] // 6) * IMG_WIDTH / \
-            (img.shape[1] * 4/3) / MODEL_SCALE
-        x = np.round(x).astype('int')
-        # x = int(round(x))
-        y = (ys[i] - img.shape[0] // 2) * IMG_HEIGHT / \
-            (img.shape[0] // 2) / MODEL_SCALE
-        y = np.round(y).astype('int')
-        # y = int(round(y))
+        x = np.round(cols[i]).astype('int')
+        y = np.round(rows[i]).astype('int')
         if x >= 0 and x < modelWidth and y >= 0 and y < modelHeight:
             mask[y, x] = 1
             regr_dict = carinfo_cleanup(car_pose[i])
@@ -1,7 +1,8 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import cv2
 from util import str2coords, coords2img, euler2mat
+from camera_model import Camera
+from render import draw_cars
 
 PATH = 'Dataset/'
 
@@ -57,6 +58,7 @@ def mark_car(img, coord, p, camera_mat):
 
 def plt_car(camera_mat, coord_str, img_id):
     # plot the car center with red dot
+    import matplotlib.pyplot as plt
     plt.figure()
     plt.imshow(cv2.imread(PATH + 'train_images/' + img_id + '.jpg'))
     plt.scatter(*coords2img(coord_str, camera_mat), color='red', s=50)
@@ -70,15 +72,5 @@ def plt_cars(img, camera_mat, coord_str):
 
 
 def plt_cars_coords(img, camera_mat, coords):
-    x_l = 1.02
-    y_l = 0.80
-    z_l = 2.31
-    p = np.array([[x_l, -y_l, -z_l, 1],
-                  [x_l, -y_l, z_l, 1],
-                  [-x_l, -y_l, z_l, 1],
-                  [-x_l, -y_l, -z_l, 1],
-                  [0, 0, 0, 1]]).T
-    img = img.copy()
-    for coord in coords:
-        mark_car(img, coord, p, camera_mat)
-    return img
\ No newline at end of file
+    # all cars are projected at once, see render.draw_cars
+    return draw_cars(img, coords, Camera.from_matrix(camera_mat))